@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+File: bench_geom.py
+Description: Benchmarks of the geom helpers on synthetic street networks.
+
+A reproducible, Montreal-like street network is generated for each scale: a
+grid rotated like the Montreal street grid, with rectangular blocks, curved
+streets and a few multi-part streets, in MONTREAL_CRS. Query points are
+scattered along the streets, on both sides.
+
+Each benchmark reports its run time, throughput (query points per second)
+and the peak memory allocated through Python and NumPy (tracemalloc, GEOS
+allocations are not counted). Timings are compared to a stored baseline and
+regressions are flagged. The baseline records the machine and the library
+versions it was measured with. Timings from another environment are not
+comparable, so a warning is printed when they differ.
+
+Usage :
+    python bench_geom.py                        # compare to the baseline
+    python bench_geom.py --scales 1000 10000    # other scales
+    python bench_geom.py --save-baseline        # store the current timings
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+import geom
+import kernels
+from geom import MONTREAL_CRS
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_geom_baseline.json')
+DEFAULT_SCALES = [1_000, 10_000, 100_000, 1_000_000]
+# libraries whose version is stored with the baseline
+LIBRARIES = ['numpy', 'pandas', 'shapely', 'geopandas', 'pyproj', 'scipy', 'numba']
+# scalar functions are only timed up to this number of points
+SCALAR_MAX_N = 10_000
+
+MONTREAL_ORIGIN = (296_000., 5_040_000.)
+GRID_ANGLE = np.radians(34)
+BLOCK_SIZE = (80., 250.)
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Argument parser for the script
+
+    Return
+    ------
+    argparse.Namespace
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(
+            description="Benchmark the geom helpers on synthetic street networks."
+            )
+    parser.add_argument("--scales", nargs='+', type=int, default=DEFAULT_SCALES,
+                        help="Number of query points of each run, default: " +
+                        ' '.join(map(str, DEFAULT_SCALES)))
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic data.")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="Path of the baseline timings.")
+    parser.add_argument("--save-baseline", action="store_true", dest='save_baseline',
+                        help="Store the timings of this run as the baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Relative slowdown tolerated before flagging a " +
+                        "regression, default: 0.5 (50%%).")
+
+    return parser.parse_args()
+
+def synthetic_network(n_segments:int, seed:int=0) -> gpd.GeoDataFrame:
+    """Generate a rotated street grid of about n_segments segments.
+
+    One street out of ten is curved and one out of fifty is split in two
+    parts (MultiLineString).
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Columns ID_TRC and geometry, in MONTREAL_CRS.
+    """
+    rng = np.random.default_rng(seed)
+    n_side = max(2, int(np.sqrt(n_segments / 2)))
+    block_w, block_h = BLOCK_SIZE
+
+    i, j = np.meshgrid(np.arange(n_side), np.arange(n_side), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    starts = np.concatenate([np.c_[i * block_w, j * block_h]] * 2)
+    ends = np.concatenate([np.c_[(i + 1) * block_w, j * block_h],
+                           np.c_[i * block_w, (j + 1) * block_h]])
+
+    # 5 vertices per street, curved streets bend up to a fifth of the block
+    ratio = np.linspace(0, 1, 5)
+    coords = starts[:, None] + ratio[None, :, None] * (ends - starts)[:, None]
+    curved = rng.random(len(starts)) < 0.1
+    normal = (ends - starts)[:, ::-1] * [1, -1] / np.hypot(*(ends - starts).T)[:, None]
+    bend = rng.uniform(-0.2, 0.2, len(starts)) * min(BLOCK_SIZE) * curved
+    coords += np.sin(np.pi * ratio)[None, :, None] * (bend[:, None] * normal)[:, None]
+
+    rotation = np.array([[np.cos(GRID_ANGLE), -np.sin(GRID_ANGLE)],
+                         [np.sin(GRID_ANGLE), np.cos(GRID_ANGLE)]])
+    coords = coords @ rotation.T + MONTREAL_ORIGIN
+
+    lines = shapely.linestrings(coords)
+    for k in np.flatnonzero(rng.random(len(lines)) < 0.02):
+        lines[k] = shapely.MultiLineString([coords[k, :3], coords[k, 3:]])
+
+    return gpd.GeoDataFrame({'ID_TRC': np.arange(len(lines))}, geometry=lines,
+                            crs=MONTREAL_CRS)
+
+def synthetic_points(network:gpd.GeoDataFrame, n_points:int, seed:int=0
+                     ) -> Tuple[gpd.GeoDataFrame, np.ndarray]:
+    """Scatter points along the streets of network, 2 to 15 meters away on
+    either side.
+
+    Returns
+    -------
+    points : gpd.GeoDataFrame
+        The query points.
+    rows : np.ndarray[int]
+        Row of the street each point was generated from.
+    """
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.integers(0, len(network), n_points)
+    lines = shapely.get_geometry(np.asarray(network.geometry.values, dtype=object)[rows], 0)
+
+    position = rng.uniform(0.05, 0.95, n_points)
+    on_line = shapely.get_coordinates(shapely.line_interpolate_point(lines, position,
+                                                                     normalized=True))
+    ahead = shapely.get_coordinates(shapely.line_interpolate_point(lines, position + 0.01,
+                                                                   normalized=True))
+    direction = (ahead - on_line) / np.hypot(*(ahead - on_line).T)[:, None]
+    offset = rng.uniform(2, 15, n_points) * rng.choice([-1, 1], n_points)
+    points_xy = on_line + offset[:, None] * direction[:, ::-1] * [1, -1]
+
+    return gpd.GeoDataFrame(geometry=shapely.points(points_xy), crs=network.crs), rows
+
+def measure(func:Callable) -> Tuple[float, float]:
+    """Run func once.
+
+    Returns
+    -------
+    seconds, peak_mib
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak / 2**20
+
+def benchmarks(network:gpd.GeoDataFrame, points:gpd.GeoDataFrame,
+               rows:np.ndarray) -> Dict[str, Callable]:
+    """The functions to time on one network and set of points.
+
+    The functions using great circle distances, like the scalar helpers, are
+    run on a copy of the data in EPSG:4326.
+    """
+    n_points = len(points)
+    roads = np.asarray(network.geometry.values, dtype=object)[rows]
+    parts = shapely.get_geometry(roads, 0)
+    pts = np.asarray(points.geometry.values, dtype=object)
+
+    roads_deg = np.asarray(gpd.GeoSeries(roads, crs=network.crs).to_crs('epsg:4326').values,
+                           dtype=object)
+    parts_deg = shapely.get_geometry(roads_deg, 0)
+    pts_deg = np.asarray(points.geometry.to_crs('epsg:4326').values, dtype=object)
+
+    benches = {
+        'ckdnearest': lambda: geom.ckdnearest(points, network, 'ID_TRC'),
+        'ckdnearest_segment': lambda: geom.ckdnearest(points, network, 'ID_TRC',
+                                                      segment_spacing=10),
+        'rtreenearest': lambda: geom.rtreenearest(points, network, 'ID_TRC'),
+        'vectorized_r_o_l': lambda: geom.vectorized_r_o_l(roads, pts, great_circle=False),
+        'vectorized_r_o_l_great_circle': lambda: geom.vectorized_r_o_l(roads_deg, pts_deg),
+        'closest_sub_lines': lambda: geom.closest_sub_lines(parts, pts, great_circle=False),
+        'vectorized_dist': lambda: geom.vectorized_dist(parts_deg, pts_deg),
+    }
+    if n_points <= SCALAR_MAX_N:
+        benches.update({
+            'multipointobject_left_or_right': lambda: [
+                geom.multipointobject_left_or_right(road, point)
+                for road, point in zip(roads_deg, pts_deg)],
+            'get_closest_sub_line': lambda: [
+                geom.get_closest_sub_line(part, point)
+                for part, point in zip(parts_deg, pts_deg)],
+            'distance': lambda: [geom.distance(part, point)
+                                 for part, point in zip(parts_deg, pts_deg)],
+        })
+    return benches
+
+def environment() -> Dict[str, object]:
+    """The machine, Python and library versions the benchmarks run with."""
+    env = {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'system': platform.platform(),
+        'python': platform.python_version(),
+        'kernels': kernels.BACKEND,
+    }
+    for name in LIBRARIES:
+        try:
+            env[name] = __import__(name).__version__
+        except ImportError:
+            env[name] = None
+    return env
+
+def read_baseline(path:str) -> Tuple[Dict[str, object], Dict[str, Dict[str, float]]]:
+    """Environment and timings (by benchmark and scale) of the baseline."""
+    if not os.path.exists(path):
+        return {}, {}
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    return baseline.get('environment', {}), baseline.get('timings', {})
+
+def save_baseline(env:Dict[str, object], timings:Dict[str, Dict[str, float]],
+                  path:str) -> None:
+    with open(path, 'w+') as f:
+        json.dump({'environment': env, 'timings': timings}, f, indent=2, sort_keys=True)
+
+def main():
+    """Run every benchmark at every scale and compare with the baseline."""
+    config = parse_args()
+
+    env = environment()
+    baseline_env, baseline = read_baseline(config.baseline)
+    changed = [key for key in env if baseline_env.get(key) != env[key]]
+    if baseline and changed:
+        print('Warning: the baseline was measured in another environment ('
+              + ', '.join(f'{key}: {baseline_env.get(key)} -> {env[key]}' for key in changed)
+              + '), timings are not comparable.')
+    results: Dict[str, Dict[str, float]] = {}
+    regressions: List[str] = []
+
+    # compile the numba kernels, if any, before timing
+    network = synthetic_network(500, seed=config.seed)
+    for func in benchmarks(network, *synthetic_points(network, 100)).values():
+        func()
+
+    print(f"{'benchmark':<32}{'points':>10}{'seconds':>10}{'points/s':>12}"
+          f"{'peak MiB':>10}{'baseline':>10}")
+    for scale in config.scales:
+        network = synthetic_network(max(500, scale // 2), seed=config.seed)
+        points, rows = synthetic_points(network, scale, seed=config.seed)
+
+        for name, func in benchmarks(network, points, rows).items():
+            seconds, peak = measure(func)
+            results.setdefault(name, {})[str(scale)] = seconds
+
+            reference = baseline.get(name, {}).get(str(scale))
+            status = ''
+            if reference is not None and seconds > reference * (1 + config.tolerance):
+                status = '  REGRESSION'
+                regressions.append(f'{name} @ {scale}')
+            reference = f'{reference:.3f}' if reference is not None else '-'
+            print(f"{name:<32}{scale:>10}{seconds:>10.3f}{scale / seconds:>12.0f}"
+                  f"{peak:>10.1f}{reference:>10}{status}")
+
+    if config.save_baseline:
+        if changed:
+            # timings of another environment are not kept
+            baseline = {}
+        for name, timings in results.items():
+            baseline.setdefault(name, {}).update(timings)
+        save_baseline(env, baseline, config.baseline)
+        print(f'Baseline saved to {config.baseline}')
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
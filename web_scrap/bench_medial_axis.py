@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+File: bench_medial_axis.py
+Description: Time/accuracy tradeoff of the Centerline medial axis settings.
+
+Every configuration of `transform_data.approximate_medial_axis` is run on the
+same polygons and compared to a reference axis: the longest path of a
+Centerline skeleton computed with a fine interpolation distance. Accuracy is
+the Hausdorff distance to the reference and the ratio of the axis length to
+the reference length.
+
+Usage :
+    python bench_medial_axis.py
+    python bench_medial_axis.py --polygons other.geojson --sample 200
+"""
+import time
+import argparse
+from typing import Dict, List
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from centerline.geometry import Centerline
+
+from geom import MONTREAL_CRS
+from projection import to_crs
+from transform_data import approximate_medial_axis, longest_path
+
+DEFAULT_POLYGONS = 'output/vsmpe_srrr_troncon_POLYGON.geojson'
+REFERENCE_INTERPOLATION = 0.1
+
+CONFIGS: Dict[str, dict] = {
+    'default (0.5)': {},
+    'fixed 1.0': {'interpolation_distance': 1.},
+    'adaptive': {'adaptive': True},
+    'adaptive, simplify 0.1': {'adaptive': True, 'simplify_tolerance': 0.1},
+    'adaptive, simplify 0.5': {'adaptive': True, 'simplify_tolerance': 0.5},
+}
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Argument parser for the script
+
+    Return
+    ------
+    argparse.Namespace
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(
+            description="Benchmark the medial axis settings on real polygons."
+            )
+    parser.add_argument("--polygons", default=DEFAULT_POLYGONS,
+                        help="Polygons file, default: " + DEFAULT_POLYGONS)
+    parser.add_argument("--sample", type=int, default=100,
+                        help="Number of polygons drawn at random, 0 for all.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the sample.")
+
+    return parser.parse_args()
+
+def run(polygons:List[shapely.Polygon], **kwargs) -> Dict[str, np.ndarray]:
+    """Compute the medial axis of every polygon with one configuration.
+
+    Returns
+    -------
+    dict
+        The axes and the seconds spent on each polygon.
+    """
+    axes = np.full(len(polygons), None, dtype=object)
+    seconds = np.zeros(len(polygons))
+    for i, polygon in enumerate(polygons):
+        start = time.perf_counter()
+        try:
+            axes[i] = approximate_medial_axis(polygon, **kwargs)
+        except Exception:
+            # failures are reported as missing axes
+            pass
+        seconds[i] = time.perf_counter() - start
+    return {'axes': axes, 'seconds': seconds}
+
+def main():
+    config = parse_args()
+
+    polygons = to_crs(gpd.read_file(config.polygons), MONTREAL_CRS).geometry
+    polygons = polygons[~polygons.is_empty & polygons.notna()]
+    if 0 < config.sample < len(polygons):
+        polygons = polygons.sample(config.sample, random_state=config.seed)
+    polygons = list(polygons.values)
+
+    print(f'Reference: interpolation {REFERENCE_INTERPOLATION}, {len(polygons)} polygons')
+    reference = np.array([longest_path(Centerline(p, REFERENCE_INTERPOLATION).geometry)
+                          for p in polygons], dtype=object)
+    ref_length = shapely.length(reference)
+
+    print(f"{'configuration':<26}{'seconds':>10}{'p95 ms':>10}{'failed':>8}"
+          f"{'hausdorff':>11}{'p95':>8}{'length':>9}")
+    for name, kwargs in CONFIGS.items():
+        res = run(polygons, **kwargs)
+        hausdorff = shapely.hausdorff_distance(res['axes'], reference)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            length = shapely.length(res['axes']) / ref_length
+        print(f"{name:<26}{res['seconds'].sum():>10.2f}"
+              f"{np.percentile(res['seconds'], 95) * 1000:>10.1f}"
+              f"{shapely.is_missing(res['axes']).sum():>8}"
+              f"{np.nanmean(hausdorff):>11.2f}{np.nanpercentile(hausdorff, 95):>8.2f}"
+              f"{np.nanmedian(length):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts a radius bounded, multi candidate road matching.
+
+Where `geom.rtreenearest` keeps a single road per geometry, `road_candidates`
+keeps every road within a radius, with the distance, the position of the
+projection along the road and the angle between the geometry and the road.
+All geometries are queried in a single call to the spatial index and the
+result is stored in a compact CSR layout: the candidates of geometry i are
+at positions offsets[i]:offsets[i+1] of the candidate arrays.
+
+Usage :
+    cands = road_candidates(df, roads, radius=10)
+    df['ID_TRC'] = cands.best(roads['ID_TRC'], by='angle')
+"""
+from typing import Tuple
+from numpy.typing import ArrayLike
+
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+
+from geom import (
+    _as_geometry_array,
+    _closest_parts,
+    azimuths,
+    closest_sub_lines,
+    line_azimuths,
+)
+
+
+class RoadCandidates():
+    """Road candidates of a set of geometries, in CSR layout.
+
+    Candidates of each geometry are sorted by road row.
+
+    Attributes
+    ----------
+    offsets : np.ndarray[int64]
+        Candidates of geometry i are at positions offsets[i]:offsets[i+1].
+    road : np.ndarray[int64]
+        Row (position) of the candidate road in the road GeoDataFrame.
+    dist : np.ndarray[float]
+        Distance between the geometry and the road, in the units of the CRS.
+    offset : np.ndarray[float]
+        Distance along the road, from its start, of the projection of the
+        geometry anchor (the point itself, the middle of a line or the
+        centroid of a polygon).
+    angle : np.ndarray[float]
+        Acute angle, in degrees (0 - 90), between the geometry (from its
+        first to its last vertex) and the road segment closest to its anchor.
+        NaN for Points and Polygons.
+    """
+    def __init__(self, offsets:ArrayLike, road:ArrayLike, dist:ArrayLike,
+                 offset:ArrayLike, angle:ArrayLike):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.road = np.asarray(road, dtype=np.int64)
+        self.dist = np.asarray(dist, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.angle = np.asarray(angle, dtype=np.float64)
+
+    def __len__(self)->int:
+        return self.offsets.size - 1
+
+    @property
+    def counts(self)->np.ndarray:
+        """Number of candidates of each geometry."""
+        return np.diff(self.offsets)
+
+    @property
+    def geometry(self)->np.ndarray:
+        """Geometry (position in the input) of each candidate."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def candidates_of(self, i:int)->pd.DataFrame:
+        """Candidates of geometry i, as a DataFrame."""
+        pos = slice(self.offsets[i], self.offsets[i+1])
+        return pd.DataFrame({'road': self.road[pos], 'dist': self.dist[pos],
+                             'offset': self.offset[pos], 'angle': self.angle[pos]})
+
+    def to_frame(self)->pd.DataFrame:
+        """Every candidate as a row of a DataFrame, in long format."""
+        return pd.DataFrame({'geometry_i': self.geometry, 'road': self.road,
+                             'dist': self.dist, 'offset': self.offset,
+                             'angle': self.angle})
+
+    def best(self, labels:ArrayLike=None, by:str='dist')->np.ndarray:
+        """Pick one candidate per geometry.
+
+        Parameters
+        ----------
+        labels : ArrayLike, optional
+            Labels of the roads (ID_TRC, ...) to return instead of their row.
+            The default is None.
+        by : str, optional
+            'dist' keeps the closest road, then the most parallel one. 'angle'
+            keeps the most parallel road, then the closest one. Remaining ties
+            go to the first road row. The default is 'dist'.
+
+        Raises
+        ------
+        ValueError
+            Unknown criteria.
+
+        Returns
+        -------
+        best : np.ndarray
+            Row of the best road for each geometry, -1 when there is no
+            candidate. When labels are given, the label of the best road, NaN
+            (None for object labels) when there is no candidate.
+        """
+        if by == 'dist':
+            keys = (self.road, self.angle, self.dist)
+        elif by == 'angle':
+            keys = (self.road, self.dist, self.angle)
+        else:
+            raise ValueError(f"Expecting 'dist' or 'angle', received {by}")
+
+        geometry_i = self.geometry
+        # NaN angles are sorted last, so they never win over a real angle
+        order = np.lexsort(keys + (geometry_i,))
+        first = order[self.offsets[:-1][self.counts > 0]]
+
+        best = np.full(len(self), -1, dtype=np.int64)
+        best[geometry_i[first]] = self.road[first]
+        if labels is None:
+            return best
+        return pd.Series(labels).reset_index(drop=True).reindex(best).to_numpy()
+
+
+def _anchors(geoms:np.ndarray)->np.ndarray:
+    """The point, the middle of the line or the centroid of each geometry."""
+    types = shapely.get_type_id(geoms)
+    lines = (types == shapely.GeometryType.LINESTRING) | \
+            (types == shapely.GeometryType.MULTILINESTRING)
+    anchors = geoms.copy()
+    anchors[lines] = shapely.line_interpolate_point(geoms[lines], 0.5, normalized=True)
+    other = ~lines & (types != shapely.GeometryType.POINT)
+    anchors[other] = shapely.centroid(geoms[other])
+    return anchors
+
+def _road_directions(roads:np.ndarray, points:np.ndarray
+                     )->Tuple[np.ndarray, np.ndarray]:
+    """First and last vertex of the segment of each road closest to the
+    matching point, as arrays of shape (n, 2)."""
+    parts = _closest_parts(roads, points)
+    seg_i, _, _ = closest_sub_lines(parts, points, great_circle=False)
+    return (shapely.get_coordinates(shapely.get_point(parts, seg_i)),
+            shapely.get_coordinates(shapely.get_point(parts, seg_i + 1)))
+
+def road_candidates(gdf_a:geopandas.GeoDataFrame,
+                    gdf_b:geopandas.GeoDataFrame,
+                    radius:float,
+                    index=None
+                    )->RoadCandidates:
+    """For each geometry in gdf_a, find every road of gdf_b within radius.
+
+    Parameters
+    ----------
+    gdf_a : geopandas.GeoDataFrame
+        Geometries to match: Points, LineStrings or Polygons.
+    gdf_b : geopandas.GeoDataFrame
+        The roads, made of LineStrings and MultiLineStrings, in the same
+        projected CRS as gdf_a.
+    radius : float
+        Search radius, in the units of the CRS.
+    index : index_cache.SpatialIndex, optional
+        Cached spatial index of gdf_b, whose STRtree is used instead of
+        gdf_b.sindex. The default is None.
+
+    Returns
+    -------
+    RoadCandidates
+        Candidates of each geometry of gdf_a, by position. Roads are given by
+        their position in gdf_b.
+    """
+    geoms = _as_geometry_array(gdf_a.geometry.values)
+    roads = _as_geometry_array(gdf_b.geometry.values)
+
+    tree = index.strtree() if index is not None else gdf_b.sindex
+    geom_i, road_i = tree.query(geoms, predicate='dwithin', distance=radius)
+    order = np.lexsort((road_i, geom_i))
+    geom_i, road_i = geom_i[order].astype(np.int64), road_i[order].astype(np.int64)
+
+    offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(geom_i, minlength=len(geoms)))
+    if geom_i.size == 0:
+        return RoadCandidates(offsets, road_i, np.empty(0), np.empty(0), np.empty(0))
+
+    cand_geoms, cand_roads = geoms[geom_i], roads[road_i]
+    anchors = _anchors(cand_geoms)
+
+    dist = shapely.distance(cand_geoms, cand_roads)
+    offset = shapely.line_locate_point(cand_roads, anchors)
+
+    angle = np.full(geom_i.size, np.nan)
+    types = shapely.get_type_id(cand_geoms)
+    lines = np.flatnonzero((types == shapely.GeometryType.LINESTRING) |
+                           (types == shapely.GeometryType.MULTILINESTRING))
+    if lines.size:
+        seg_start, seg_end = _road_directions(cand_roads[lines], anchors[lines])
+        diff = np.abs(line_azimuths(cand_geoms[lines]) - azimuths(seg_start, seg_end)) % 180
+        angle[lines] = np.minimum(diff, 180 - diff)
+
+    return RoadCandidates(offsets, road_i, dist, offset, angle)
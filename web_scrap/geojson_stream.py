@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts streaming GeoJSON writers and readers, so that scraped
+tables never have to be held in memory as a whole.
+
+`FeatureSink` writes features as they arrive, either as a FeatureCollection
+(one feature per line, readable by any GeoJSON reader) or as newline
+delimited GeoJSON. The CRS is written up front, in the collection header or
+in a header line. The file is written under a temporary name and only
+renamed when the sink is closed without error, so a partial download never
+looks complete.
+
+`iter_features` reads back both formats one feature at a time, and
+`read_geojson` builds a GeoDataFrame from it by chunks.
+
+Usage :
+    with FeatureSink('output/table.geojson', crs='epsg:2950') as sink:
+        for page in pages:
+            sink.write(page)
+    df = read_geojson('output/table.geojson')
+"""
+import os
+import json
+from typing import Iterable, Iterator, Tuple
+
+import pandas as pd
+import geopandas
+
+# extensions of the newline delimited files
+NDJSON_EXT = ('.geojsonl', '.geojsons', '.geojsonseq', '.ndjson', '.jsonl')
+# bytes read at once by the streaming parser
+READ_SIZE = 1 << 20
+# features converted at once by read_geojson
+CHUNK_SIZE = 50_000
+
+_DECODER = json.JSONDecoder()
+
+
+def is_ndjson(filename:str) -> bool:
+    """ Whether filename is newline delimited GeoJSON, from its extension."""
+    return filename.lower().endswith(NDJSON_EXT)
+
+def crs_member(crs:str) -> dict:
+    """ GeoJSON crs member of a CRS name, ie 'epsg:2950'."""
+    return {'type': 'name', 'properties': {'name': crs}}
+
+
+class FeatureSink():
+    """ Write GeoJSON features to a file as they arrive.
+
+    Attributes
+    ----------
+    filename : str
+        Final name of the file.
+    ndjson : bool
+        Newline delimited GeoJSON instead of a FeatureCollection.
+    n_features : int
+        Number of features written so far.
+    """
+    def __init__(self, filename:str, crs:str=None, ndjson:bool=None):
+        self.filename = os.path.normpath(filename)
+        self.ndjson = is_ndjson(self.filename) if ndjson is None else ndjson
+        self.n_features = 0
+
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        self._part = self.filename + '.part'
+        self._file = open(self._part, 'w', encoding='utf-8')
+
+        header = {'type': 'FeatureCollection'}
+        if crs is not None:
+            header['crs'] = crs_member(crs)
+        if self.ndjson:
+            self._file.write(json.dumps(header) + '\n')
+        else:
+            # the header without its closing brace, features follow
+            self._file.write(json.dumps(header)[:-1] + ', "features": [')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(discard=exc_type is not None)
+
+    def _write_line(self, line:str) -> None:
+        if self.ndjson:
+            self._file.write(line + '\n')
+        else:
+            self._file.write(('\n' if self.n_features == 0 else ',\n') + line)
+        self.n_features += 1
+
+    def write(self, features:Iterable[dict]) -> None:
+        """ Append features to the file."""
+        for feature in features:
+            self._write_line(json.dumps(feature))
+
+    def append_file(self, filename:str) -> None:
+        """ Append the features of a newline delimited file written by a
+        FeatureSink, without decoding them."""
+        with open(filename, encoding='utf-8') as f:
+            # skip the header line
+            next(f, None)
+            for line in f:
+                line = line.rstrip('\n')
+                if line:
+                    self._write_line(line)
+
+    def close(self, discard:bool=False) -> None:
+        """ Finish the file and give it its final name, or delete it when
+        discard is True."""
+        if self._file.closed:
+            return
+        if not self.ndjson:
+            self._file.write('\n]}\n')
+        self._file.close()
+        if discard:
+            os.remove(self._part)
+        else:
+            os.replace(self._part, self.filename)
+
+
+class _Stream():
+    """ Buffered reader of JSON values, for the streaming parser."""
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(READ_SIZE)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self) -> str:
+        """ Next non blank character, consumed."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                self.pos += 1
+                return self.buf[self.pos - 1]
+            if not self._fill():
+                raise ValueError('Unexpected end of the GeoJSON file.')
+
+    def value(self):
+        """ Next JSON value, consumed."""
+        self.next_char()
+        self.pos -= 1
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # the value may continue in the next chunk
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+def _iter_collection(f) -> Iterator[Tuple[str, object]]:
+    """ Members of the top level object of a GeoJSON file, the features being
+    yielded one by one as ('feature', feature)."""
+    stream = _Stream(f)
+    if stream.next_char() != '{':
+        raise ValueError('Expecting a GeoJSON object.')
+    char = stream.next_char()
+    while char != '}':
+        stream.pos -= 1
+        key = stream.value()
+        if stream.next_char() != ':':
+            raise ValueError('Malformed GeoJSON object.')
+        if key == 'features':
+            if stream.next_char() != '[':
+                raise ValueError('Expecting an array of features.')
+            char = stream.next_char()
+            while char != ']':
+                stream.pos -= 1
+                yield 'feature', stream.value()
+                char = stream.next_char()
+                if char == ',':
+                    char = stream.next_char()
+        else:
+            yield key, stream.value()
+        char = stream.next_char()
+        if char == ',':
+            char = stream.next_char()
+
+def iter_features(filename:str) -> Iterator[Tuple[str, object]]:
+    """ Read a FeatureCollection or a newline delimited GeoJSON file, one
+    feature at a time.
+
+    Yields
+    ------
+    (member, value)
+        ('feature', feature) for each feature, in file order, and
+        (member, value) for the other members of the collection, ie
+        ('crs', {...}), in file order.
+    """
+    with open(filename, encoding='utf-8') as f:
+        if not is_ndjson(filename):
+            yield from _iter_collection(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'Feature':
+                yield 'feature', record
+            else:
+                # header line
+                for key, value in record.items():
+                    if key != 'features':
+                        yield key, value
+
+def read_geojson(filename:str, chunk_size:int=CHUNK_SIZE) -> geopandas.GeoDataFrame:
+    """ Read a GeoJSON file written by a FeatureSink, or any GeoJSON file,
+    into a GeoDataFrame, without holding every feature as a dict.
+
+    Parameters
+    ----------
+    filename : str
+        FeatureCollection or newline delimited GeoJSON file.
+    chunk_size : int, optional
+        Number of features converted at once. The default is CHUNK_SIZE.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        In the CRS named by the crs member of the file, EPSG:4326 without a
+        named crs.
+    """
+    crs = 'EPSG:4326'
+    frames, chunk = [], []
+    for key, value in iter_features(filename):
+        if key == 'crs':
+            # files written in one go may have their crs after the features,
+            # link and null crs members are ignored
+            crs = ((value or {}).get('properties') or {}).get('name') or 'EPSG:4326'
+        elif key == 'feature':
+            chunk.append(value)
+            if len(chunk) >= chunk_size:
+                frames.append(geopandas.GeoDataFrame.from_features(chunk))
+                chunk = []
+    if chunk or not frames:
+        frames.append(geopandas.GeoDataFrame.from_features(chunk))
+
+    gdf = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    # geometry last, as geopandas.read_file
+    gdf = gdf[[col for col in gdf.columns if col != 'geometry'] + ['geometry']]
+    return geopandas.GeoDataFrame(gdf, geometry='geometry', crs=crs)
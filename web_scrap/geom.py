@@ -8,26 +8,31 @@ Created on Wed Jun 9 2021 10:12:56
 @author: alaurent
 """
 import math
-from operator import itemgetter
 import itertools
-from typing import List
+from typing import List, Tuple
 from numpy.typing import ArrayLike
 
 import shapely
 import numpy as np
 import pandas as pd
 import geopandas
-from geopy.distance import geodesic
 from pyproj import CRS
 from scipy.spatial import cKDTree
 
+import kernels
+from geodesy import EARTH_RADIUS, geodesic_distance
+from kernels import cross_sign, group_argmin
+
 
 UNIVERSAL_CRS = CRS.from_epsg(3857)
 DEFAULT_CRS = CRS.from_epsg(4326)
 MONTREAL_CRS = CRS.from_epsg(32188)
 
-EARTH_RADIUS = 6371000
 
+def _as_geometry_array(geoms) -> np.ndarray:
+    """Convert a geometry, a sequence of geometries or a GeoSeries into a numpy
+    array of shapely objects."""
+    return np.asarray(geoms, dtype=object)
 
 def vector_left_or_right(vector: shapely.LineString,
                          point: shapely.LineString
@@ -122,8 +127,7 @@ def distance_norm_2(p_1:shapely.Point, p_2:shapely.Point)-> float:
     result: float
         The distance between both points. This distance is always positive.
     """
-    _d = p_1-p_2
-    return math.sqrt(_d.x**2+_d.y**2)
+    return math.sqrt((p_1.x-p_2.x)**2+(p_1.y-p_2.y)**2)
 
 def find_closest_to_point(candidates:shapely.geometry.base.BaseMultipartGeometry,
                           point:shapely.Point, great_circle:bool=True)-> shapely.LineString:
@@ -139,33 +143,41 @@ def find_closest_to_point(candidates:shapely.geometry.base.BaseMultipartGeometry
     point : shapely.Point
         The point whose distance with the multi part geometry must be calculated.
     great_circle : bool, optional
-        When True, the geodesic distance is used. When False, the euclidien
-        distance is used. The default is True.
+        When True, the geodesic distance is used, coordinates being (lon,
+        lat) degrees. When False, the euclidien distance is used. The default
+        is True.
 
     Returns
     -------
-    TYPE
-        DESCRIPTION.
+    closest : shapely.Geometry
+        The closest part of candidates. On equal distances, the first one is
+        returned.
 
     """
 
     if float('.'.join(shapely.__version__.split('.')[:2])) >= 1.8:
         candidates = candidates.geoms
 
-    closest = (None, np.inf)
-    for candidate in candidates:
-        if isinstance(candidate, shapely.Point):
-            if great_circle:
-                dist = geodesic((candidate.x, candidate.y), (point.x, point.y)).m
-            else:
-                dist = distance_norm_2(candidate, point)
-        else:
-            dist = candidate.distance(point)
-        if dist < closest[-1]:
-            closest = (candidate, dist)
+    candidates = _as_geometry_array(list(candidates))
+    if candidates.size == 0:
+        return None
+
+    # points distances are computed in one call, other parts use shapely
+    dist = shapely.distance(candidates, point)
+    is_point = shapely.get_type_id(candidates) == shapely.GeometryType.POINT
+    if is_point.any():
+        coords = shapely.get_coordinates(candidates[is_point])
+        if great_circle:
+            dist[is_point] = geodesic_distance(coords[:, 1], coords[:, 0],
+                                               point.y, point.x)
         else:
-            pass
-    return closest[0]
+            dist[is_point] = np.sqrt((coords[:, 0]-point.x)**2 +
+                                     (coords[:, 1]-point.y)**2)
+
+    dist = np.where(np.isnan(dist), np.inf, dist)
+    if not (dist < np.inf).any():
+        return None
+    return candidates[np.argmin(dist)]
 
 def vectorize(points:List[shapely.Point])->shapely.LineString:
     """
@@ -247,35 +259,144 @@ def normalize_vector(vector:shapely.LineString)->shapely.LineString:
     p_1, _ = multipointobject_to_points(vector)
     return shapely.LineString(coordinates=[[p_1.x, p_1.y], [p_1.x + _u, p_1.y + _v]])
 
+def _end_points(geoms:ArrayLike)->Tuple[np.ndarray, np.ndarray]:
+    """First and last vertex of each geometry, as arrays of shape (n, 2). For
+    multi part geometries, the first vertex of the first part and the last
+    vertex of the last part. NaN for empty or missing geometries."""
+    geoms = _as_geometry_array(geoms).ravel()
+    coords, geom_ix = shapely.get_coordinates(geoms, return_index=True)
+    counts = np.bincount(geom_ix, minlength=geoms.size)
+    starts = np.cumsum(counts) - counts
+
+    first_xy = np.full((geoms.size, 2), np.nan)
+    last_xy = np.full((geoms.size, 2), np.nan)
+    valid = counts > 0
+    first_xy[valid] = coords[starts[valid]]
+    last_xy[valid] = coords[starts[valid] + counts[valid] - 1]
+    return first_xy, last_xy
+
+def azimuths(points1_xy:ArrayLike, points2_xy:ArrayLike)->np.ndarray:
+    """Array version of `azimuth`, on coordinate arrays of shape (..., 2)
+    broadcasted against each other.
+
+    Returns
+    -------
+    angle : np.ndarray[float]
+        The azimuth from points1 to points2, in degrees (interval 0 - 360).
+    """
+    points1_xy = np.asarray(points1_xy, dtype=float)
+    points2_xy = np.asarray(points2_xy, dtype=float)
+    angle = np.degrees(np.arctan2(points2_xy[..., 0] - points1_xy[..., 0],
+                                  points2_xy[..., 1] - points1_xy[..., 1]))
+    return np.where(angle >= 0, angle, angle + 360)
+
 def azimuth(point1:shapely.Point, point2:shapely.Point)->float:
-    '''azimuth between 2 shapely points (interval 0 - 360)'''
-    angle = np.arctan2(point2[0] - point1[0], point2[-1] - point1[1])
-    return np.degrees(angle) if angle >= 0 else np.degrees(angle) + 360
+    '''azimuth between 2 shapely points or coordinates tuples (interval 0 - 360)'''
+    point1, point2 = [(p.x, p.y) if isinstance(p, shapely.Point) else p[:2]
+                      for p in (point1, point2)]
+    return float(azimuths(point1, point2))
+
+def line_azimuths(lines:ArrayLike, reverse:bool=False)->np.ndarray:
+    """Azimuth of every line, from its first to its last vertex, in one pass.
+
+    Parameters
+    ----------
+    lines : ArrayLike[shapely.LineString | shapely.MultiLineString]
+        The lines. Can be a GeoSeries. A MultiLineString goes from the first
+        vertex of its first part to the last vertex of its last part.
+    reverse : bool, optional
+        If True, compute the azimuth from the last to the first vertex. The
+        default is False.
+
+    Returns
+    -------
+    angle : np.ndarray[float]
+        The azimuths in degrees (interval 0 - 360), NaN for empty or missing
+        lines.
+    """
+    first_xy, last_xy = _end_points(lines)
+    if reverse:
+        return azimuths(last_xy, first_xy)
+    return azimuths(first_xy, last_xy)
 
 def line_azimuth(line: shapely.LineString | shapely.MultiLineString,
                  reversed: bool = False
                  ) -> float:
-    """
-
+    """Azimuth of a line, from its first to its last vertex.
 
     Parameters
     ----------
     line : shapely.LineString | shapely.MultiLineString
-        DESCRIPTION.
+        The line. See `line_azimuths` for MultiLineStrings.
     reversed : bool, optional
-        DESCRIPTION. The default is False.
+        If True, compute the azimuth from the last to the first vertex. The
+        default is False.
 
     Returns
     -------
     float
-        DESCRIPTION.
+        The azimuth in degrees (interval 0 - 360).
 
     """
     #TODO: change "reversed" for "reverse"
-    if isinstance(line, shapely.MultiLineString):
-        return None
-    line = list(line.coords)
-    return azimuth(line[0], line[-1]) if not reversed else azimuth(line[-1], line[0])
+    return float(line_azimuths(line, reverse=reversed)[0])
+
+def _normalized_dot(starts1_xy:np.ndarray, ends1_xy:np.ndarray,
+                    starts2_xy:np.ndarray, ends2_xy:np.ndarray
+                    )->Tuple[np.ndarray, np.ndarray]:
+    """Dot product of two sets of normalized vectors, given by their start and
+    end coordinates (arrays of shape (n, 2)).
+
+    The floating point operations of `normalize_vector` and `dot_product` are
+    reproduced one by one so that the array and scalar versions agree on
+    exact comparisons.
+
+    Returns
+    -------
+    scal_prod : np.ndarray[float]
+        The dot products, clipped to [-1, 1].
+    equal : np.ndarray[bool]
+        True where both vectors have the same components.
+    """
+    uv_1 = ends1_xy - starts1_xy
+    uv_2 = ends2_xy - starts2_xy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm_1 = (starts1_xy + uv_1 / np.sqrt((uv_1**2).sum(axis=1))[:, None]) - starts1_xy
+        norm_2 = (starts2_xy + uv_2 / np.sqrt((uv_2**2).sum(axis=1))[:, None]) - starts2_xy
+    scal_prod = norm_1[:, 0]*norm_2[:, 0] + norm_1[:, 1]*norm_2[:, 1]
+    return np.clip(scal_prod, -1, 1), (uv_1 == uv_2).all(axis=1)
+
+def angles_between_vectors(vectors1:ArrayLike, vectors2:ArrayLike,
+                           as_degree:bool=False)->np.ndarray:
+    """Array version of `angle_between_vectors`. Vectors are broadcasted
+    against each other.
+
+    Parameters
+    ----------
+    vectors1 : ArrayLike[shapely.LineString]
+        First vectors. Can be a GeoSeries. Polylines are reduced to the vector
+        going from their first to their last vertex.
+    vectors2 : ArrayLike[shapely.LineString]
+        Second vectors, same as vectors1.
+    as_degree : bool, optional
+        If True, returns the result in degrees. The default is False.
+
+    Returns
+    -------
+    angle: np.ndarray[float]
+        The minimum angle between each pair of vectors, NaN for empty or
+        missing geometries.
+    """
+    vectors1, vectors2 = np.broadcast_arrays(_as_geometry_array(vectors1),
+                                             _as_geometry_array(vectors2))
+    shape = vectors1.shape
+
+    scal_prod, equal = _normalized_dot(*_end_points(vectors1), *_end_points(vectors2))
+    #to avoid the machine error, the angle is forced to zero on equal vectors
+    angle = np.where(equal, 0., np.arccos(scal_prod))
+    if as_degree:
+        angle = np.degrees(angle)
+    return angle.reshape(shape)
 
 def angle_between_vectors(vector1:shapely.LineString, vector2:shapely.LineString,
                           as_degree:bool=False)-> float:
@@ -291,22 +412,23 @@ def angle_between_vectors(vector1:shapely.LineString, vector2:shapely.LineString
     as_degree : bool, optional
         If True, returns the result in degrees. The default is False.
 
+    Raises
+    ------
+    ValueError
+        The number of coordinates in vector1 or vector2 is greater than 2.
+
     Returns
     -------
     angle: float
         The minimum angle between vector1 and vector2.
 
     """
-    #to avoid the machine error, lets first check if they are equal and force the zero
-    if (uv_coords(vector1) == uv_coords(vector2)).all():
-        angle = 0
-    else:
-        scal_prod = dot_product(normalize_vector(vector1), normalize_vector(vector2))
-        scal_prod = np.clip(scal_prod, -1, 1)
-        angle = math.acos(scal_prod)
-    if as_degree:
-        return math.degrees(angle)
-    return angle
+    if len(vector1.coords) != 2:
+        raise ValueError(f'Expecting 2 points, received {len(vector1.coords)}')
+    if len(vector2.coords) != 2:
+        raise ValueError(f'Expecting 2 points, received {len(vector2.coords)}')
+
+    return float(angles_between_vectors(vector1, vector2, as_degree=as_degree))
 
 def multipointobject_left_or_right(multipointobject: shapely.MultiLineString | shapely.LineString,
                                    point:shapely.Point
@@ -399,10 +521,173 @@ def multipointobject_left_or_right(multipointobject: shapely.MultiLineString | s
             angle = -1 * vector_left_or_right(cands[0], points[index+1])
     return angle
 
+def _is_flat_angle(a_xy:np.ndarray, b_xy:np.ndarray, c_xy:np.ndarray)->np.ndarray:
+    """Array version of `angle_between_vectors((a, b), (b, c), as_degree=True) == 180`."""
+    scal_prod, equal = _normalized_dot(a_xy, b_xy, b_xy, c_xy)
+    return ~equal & (scal_prod == -1)
+
+def _closest_parts(geoms:np.ndarray, points:np.ndarray)->np.ndarray:
+    """For each MultiLineString of geoms, keep only the part closest to the
+    matching point, as `find_closest_to_point` does.
+    """
+    multi = np.flatnonzero(shapely.get_type_id(geoms) == shapely.GeometryType.MULTILINESTRING)
+    if multi.size == 0:
+        return geoms
+
+    parts, part_ix = shapely.get_parts(geoms[multi], return_index=True)
+    dist = shapely.distance(parts, points[multi][part_ix])
+    # stable sort: on equal distances the first part wins
+    order = np.lexsort((dist, part_ix))
+    first = np.searchsorted(part_ix[order], np.arange(multi.size))
+    has_parts = np.bincount(part_ix, minlength=multi.size) > 0
+
+    geoms = geoms.copy()
+    geoms[multi] = None
+    geoms[multi[has_parts]] = parts[order[first[has_parts]]]
+    return geoms
+
+def lines_left_or_right(lines:ArrayLike, points:ArrayLike,
+                        great_circle:bool=True)->np.ndarray:
+    """Determines, for each pair of line and point, if the point is to the
+    right or left of the line. This is the array counterpart of
+    `multipointobject_left_or_right` and returns the same results, convex
+    junctions and 180° angles included.
+
+    Parameters
+    ----------
+    lines : ArrayLike[shapely.LineString | shapely.MultiLineString]
+        The objects to compare. Can be a GeoSeries.
+    points : ArrayLike[shapely.Point]
+        The points to compare. Broadcasted against lines.
+    great_circle : bool, optional
+        When True, the closest vertex of each line is searched with the
+        geodesic distance on (lon, lat) coordinates, as
+        `find_closest_to_point` does. When False, the
+        euclidien distance is used, which is suited for projected
+        coordinates. The default is True.
+
+    Returns
+    -------
+    result: np.ndarray[int]
+        The result of the comparison is a -1/0/1 indication with the following
+        meaning:
+            -1 for "left"
+            0 for "on the line" (neither right nor left), or missing geometry
+            1 for "right"
+    """
+    lines, points = np.broadcast_arrays(_as_geometry_array(lines),
+                                        _as_geometry_array(points))
+    shape = lines.shape
+    lines = lines.ravel()
+    points = points.ravel()
+    result = np.zeros(lines.size, dtype=np.int8)
+
+    lines = _closest_parts(lines, points)
+
+    # points on the line (and missing geometries, with a NaN distance) are
+    # left at 0
+    todo = np.flatnonzero(shapely.distance(lines, points) > 0)
+    if todo.size == 0:
+        return result.reshape(shape)
+
+    coords, line_ix = shapely.get_coordinates(lines[todo], return_index=True)
+    counts = np.bincount(line_ix, minlength=todo.size)
+    p_xy = shapely.get_coordinates(points[todo])
+
+    result[todo] = polylines_left_or_right(coords, counts, p_xy, great_circle)
+    return result.reshape(shape)
+
+def polylines_left_or_right(coords:np.ndarray, counts:np.ndarray,
+                            points_xy:np.ndarray, great_circle:bool=True
+                            )->np.ndarray:
+    """Core of `lines_left_or_right`, working on raw coordinate arrays.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Array of shape (n, 2), the vertices of all polylines one after the
+        other.
+    counts : np.ndarray[int]
+        Number of vertices of each polyline, at least 2.
+    points_xy : np.ndarray
+        Array of shape (len(counts), 2), one point per polyline. Points must
+        not lie on their polyline.
+    great_circle : bool, optional
+        See `lines_left_or_right`. The default is True.
+
+    Returns
+    -------
+    result: np.ndarray[int]
+        The -1/1 side of each point.
+    """
+    line_ix = np.repeat(np.arange(counts.size), counts)
+    starts = np.cumsum(counts) - counts
+    p_xy = points_xy
+
+    # closest vertex of each line, first one on equal distances
+    if great_circle:
+        dist = geodesic_distance(coords[:, 1], coords[:, 0],
+                                 p_xy[line_ix, 1], p_xy[line_ix, 0])
+    else:
+        dist = np.sqrt(((coords - p_xy[line_ix])**2).sum(axis=1))
+    closest = group_argmin(dist, starts, counts)
+    index = closest - starts
+
+    first = index == 0
+    last = index == counts - 1
+    middle = ~(first | last)
+
+    # first and last vertices only have one vector to test
+    vec_start = np.where(first, closest, closest - 1)
+    side_1 = cross_sign(coords[vec_start], coords[vec_start+1], p_xy)
+    side = side_1.copy()
+
+    # the other ones are surrounded by two vectors, see
+    # multipointobject_left_or_right for the convex junction edge case
+    mid = np.flatnonzero(middle)
+    prev_xy, curr_xy, next_xy = coords[closest[mid]-1], coords[closest[mid]], coords[closest[mid]+1]
+    side_2 = cross_sign(curr_xy, next_xy, p_xy[mid])
+    opposite = -1 * cross_sign(prev_xy, curr_xy, next_xy)
+    side[mid] = np.where(
+        _is_flat_angle(prev_xy, curr_xy, next_xy),
+        -1,
+        np.where(side_1[mid] == side_2, side_1[mid], opposite)
+    )
+
+    return side
+
+def segments_projection(points_xy:np.ndarray, starts_xy:np.ndarray,
+                        ends_xy:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    """Project points on 2-points segments. Arrays are of shape (..., 2) and are
+    broadcasted against each other.
+
+    Parameters
+    ----------
+    points_xy : np.ndarray
+        The points to project.
+    starts_xy : np.ndarray
+        First point of each segment.
+    ends_xy : np.ndarray
+        Last point of each segment.
+
+    Returns
+    -------
+    dist : np.ndarray[float]
+        The euclidean distance between each point and its projection.
+    ratio : np.ndarray[float]
+        Position of the projection on the segment, between 0 (start) and 1
+        (end).
+    """
+    points_xy, starts_xy, ends_xy = np.broadcast_arrays(points_xy, starts_xy, ends_xy)
+    shape = points_xy.shape[:-1]
+    dist, ratio = kernels.segments_projection(points_xy, starts_xy, ends_xy)
+
+    return dist.reshape(shape), ratio.reshape(shape)
+
 def distance(line:shapely.LineString, point:shapely.Point)->float:
     """ Compute the geodesic distance (in meters) between a LineString and a
-    Point. The distance is computed as the projected distance between the
-    LineString and the point.
+    Point in EPSG:4326, (lon, lat). The distance is computed as the projected
+    distance between the LineString and the point.
 
     Parameters
     ----------
@@ -416,10 +701,89 @@ def distance(line:shapely.LineString, point:shapely.Point)->float:
     dist_tmp : float
         The distance between 'point' and the projected point on the line. In meters.
     """
-    point_projected = line.interpolate(line.project(point))
-    dist_tmp = geodesic((point.x, point.y), (point_projected.x, point_projected.y)).m
+    return float(lines_distance(line, point))
+
+def lines_distance(lines:ArrayLike, points:ArrayLike,
+                   method:str='geodesic')->np.ndarray:
+    """ Array version of `distance`: compute the distance (in meters) between
+    each LineString and each Point, broadcasted against each other. A whole
+    GeoSeries of lines can be processed in one call. Geometries must be in
+    (lon, lat) degrees, as EPSG:4326.
+
+    Parameters
+    ----------
+    lines : ArrayLike[shapely.LineString]
+        LineStrings to compute the distance on. Can be a GeoSeries.
+    points : ArrayLike[shapely.Point]
+        The points to compute the distance on. Can be a GeoSeries.
+    method : str, optional
+        Distance used between a point and its projection, see
+        `geodesy.geodesic_distance`. The default is 'geodesic'.
+
+    Returns
+    -------
+    dist : np.ndarray[float]
+        The distance between each point and its projection on the line, in
+        meters. NaN for missing geometries.
+    """
+    lines, points = np.broadcast_arrays(_as_geometry_array(lines),
+                                        _as_geometry_array(points))
+    projected = shapely.line_interpolate_point(lines,
+                                               shapely.line_locate_point(lines, points))
+
+    # shapely coordinates are (lon, lat), geodesy takes (lat, lon)
+    return geodesic_distance(shapely.get_y(points), shapely.get_x(points),
+                             shapely.get_y(projected), shapely.get_x(projected),
+                             method=method)
+
+def lines_linear_referencing(lines:ArrayLike, roads:ArrayLike, clip:bool=False,
+                             return_reversed:bool=False):
+    """Linear referencing of lines on roads: project the first and last vertex
+    of each line on the matching road. Inputs are broadcasted against each
+    other.
+
+    Parameters
+    ----------
+    lines : ArrayLike[shapely.LineString | shapely.MultiLineString]
+        Lines to reference (curbs, parking segments, ...). Can be a GeoSeries.
+    roads : ArrayLike[shapely.LineString | shapely.MultiLineString]
+        Roads to reference on. Can be a GeoSeries.
+    clip : bool, optional
+        If True, positions are clipped to [0, road length], which guards
+        against rounding on the road ends. The default is False.
+    return_reversed : bool, optional
+        If True, also return whether each line runs in the opposite direction
+        of its road. The default is False.
 
-    return dist_tmp
+    Returns
+    -------
+    deb : np.ndarray[float]
+        Smallest position of the two projected vertices along the road, in
+        the units of the CRS. NaN for missing geometries.
+    fin : np.ndarray[float]
+        Largest position.
+    reversed : np.ndarray[bool]
+        Only when return_reversed. True where the first vertex of the line
+        projects after its last one.
+    """
+    lines, roads = np.broadcast_arrays(_as_geometry_array(lines),
+                                       _as_geometry_array(roads))
+    shape = lines.shape
+    lines, roads = lines.ravel(), roads.ravel()
+
+    first_xy, last_xy = _end_points(lines)
+    first = shapely.line_locate_point(roads, shapely.points(first_xy))
+    last = shapely.line_locate_point(roads, shapely.points(last_xy))
+    if clip:
+        length = shapely.length(roads)
+        first = np.clip(first, 0, length)
+        last = np.clip(last, 0, length)
+
+    deb = np.fmin(first, last).reshape(shape)
+    fin = np.fmax(first, last).reshape(shape)
+    if not return_reversed:
+        return deb, fin
+    return deb, fin, (first > last).reshape(shape)
 
 def polyline_to_vectors(line:shapely.LineString)->List[shapely.LineString]:
     """Divides a polyline in a list of 2-points segments.
@@ -478,17 +842,82 @@ def get_closest_sub_line(line:shapely.LineString, point:shapely.Point)->shapely.
     if not line.is_simple:
         raise ValueError('Line must be simple.')
 
-    line_size = len(line.coords)
-
-    subsline = map(shapely.LineString, polyline_to_vectors(line))
-    points = itertools.repeat(point, line_size-1)
-
-    id_line = np.argmin(list(map(distance, subsline, points)))
-    id_line = int(id_line)
+    id_line = int(closest_sub_lines(line, point)[0][0])
     subline = shapely.LineString([line.coords[id_line], line.coords[id_line+1]])
 
     return subline
 
+def closest_sub_lines(lines:ArrayLike, points:ArrayLike, great_circle:bool=True
+                      )->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Array version of `get_closest_sub_line`: for each pair of polyline and
+    point, find the closest segment of the polyline and project the point on
+    it.
+
+    Parameters
+    ----------
+    lines : ArrayLike[shapely.LineString]
+        Polylines to analyse. Can be a GeoSeries.
+    points : ArrayLike[shapely.Point]
+        Points to compare. Broadcasted against lines.
+    great_circle : bool, optional
+        When True, segments are compared with the geodesic distance between
+        the point and its projection, on (lon, lat) coordinates, as
+        `get_closest_sub_line` does. When
+        False, the euclidien distance is used, which is suited for projected
+        coordinates. The default is True.
+
+    Raises
+    ------
+    ValueError
+        Something else than a LineString was passed.
+
+    Returns
+    -------
+    index : np.ndarray[int]
+        Index of the closest segment, segment i going from vertex i to vertex
+        i+1.
+    projected : np.ndarray
+        Array of shape (n, 2), coordinates of the projection of each point on
+        its closest segment.
+    offset : np.ndarray[float]
+        Distance from the start of the polyline to the projected point, along
+        the polyline and in the units of the CRS.
+    """
+    lines, points = np.broadcast_arrays(_as_geometry_array(lines),
+                                        _as_geometry_array(points))
+    lines = lines.ravel()
+    points = points.ravel()
+    if (shapely.get_type_id(lines) != shapely.GeometryType.LINESTRING).any():
+        raise ValueError('Expecting LineString objects only.')
+
+    coords, line_ix = shapely.get_coordinates(lines, return_index=True)
+    counts = np.bincount(line_ix, minlength=lines.size)
+    starts = np.cumsum(counts) - counts
+    p_xy = shapely.get_coordinates(points)
+
+    seg_counts = counts - 1
+    seg_first = np.cumsum(seg_counts) - seg_counts
+    seg_start = concat_ranges(starts, seg_counts)
+    seg_line = np.repeat(np.arange(lines.size), seg_counts)
+    starts_xy, ends_xy = coords[seg_start], coords[seg_start + 1]
+
+    dist, ratio = segments_projection(p_xy[seg_line], starts_xy, ends_xy)
+    projected = starts_xy + ratio[:, None] * (ends_xy - starts_xy)
+    if great_circle:
+        dist = geodesic_distance(p_xy[seg_line, 1], p_xy[seg_line, 0],
+                                 projected[:, 1], projected[:, 0])
+    best = group_argmin(dist, seg_first, seg_counts)
+
+    # length of the polyline before each segment
+    seg_length = np.sqrt(((ends_xy - starts_xy)**2).sum(axis=1))
+    before = np.cumsum(seg_length) - seg_length
+    before -= np.repeat(before[seg_first], seg_counts)
+
+    index = seg_start[best] - starts
+    offset = before[best] + ratio[best] * seg_length[best]
+
+    return index, projected[best], offset
+
 
 def is_left(line:shapely.LineString, point:shapely.Point) -> bool:
     """Determine if a point is on the left of a given line
@@ -511,12 +940,79 @@ def is_left(line:shapely.LineString, point:shapely.Point) -> bool:
     return ((_b.x - _a.x)*(point.y - _a.y) - (_b.y - _a.y)*(point.x - _a.x)) > 0
 
 
+def concat_ranges(starts:np.ndarray, counts:np.ndarray)->np.ndarray:
+    """Concatenate the ranges [starts[i], starts[i] + counts[i]) in one array."""
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - ends + counts, counts) + \
+           np.arange(ends[-1] if ends.size else 0)
+
+def argmin_per_group(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Return the position of the minimum value of each group. On equal values,
+    the first one (in input order) is kept, as a `<` comparison loop would do.
+    """
+    order = np.lexsort((values, groups))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    return order[first]
+
+def _segment_candidates(ckd_tree: cKDTree,
+                        points_xy: np.ndarray,
+                        vertex_row: np.ndarray,
+                        spacing: float,
+                        k: int
+                        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Find, for each point, every row of a densified geometry set that may
+    hold the closest segment.
+
+    Vertices are at most `spacing` apart, so the closest segment always has a
+    vertex within the distance to the closest vertex plus spacing / 2.
+
+    Returns
+    -------
+    point_i, row_i : np.ndarray[int], np.ndarray[int]
+        Unique (point, row) candidate pairs, sorted by point then row.
+    """
+    k = min(k, ckd_tree.n)
+    dist, idx = ckd_tree.query(points_xy, k=k)
+    dist = dist.reshape(len(points_xy), k)
+    idx = idx.reshape(len(points_xy), k)
+    radius = dist[:, 0] + spacing / 2
+
+    point_i, col = np.nonzero(dist <= radius[:, None])
+    vertex_i = idx[point_i, col]
+
+    # the k nearest vertices do not cover the whole radius
+    incomplete = np.flatnonzero(dist[:, -1] <= radius)
+    if incomplete.size and k < ckd_tree.n:
+        keep = ~np.isin(point_i, incomplete)
+        balls = ckd_tree.query_ball_point(points_xy[incomplete], r=radius[incomplete])
+        sizes = np.fromiter(map(len, balls), dtype=np.int64, count=len(balls))
+        point_i = np.concatenate([point_i[keep], np.repeat(incomplete, sizes)])
+        vertex_i = np.concatenate([vertex_i[keep],
+                                   np.fromiter(itertools.chain.from_iterable(balls), dtype=np.int64,
+                                               count=sizes.sum())])
+
+    n_rows = np.int64(vertex_row.max()) + 1
+    pairs = np.unique(point_i.astype(np.int64) * n_rows + vertex_row[vertex_i])
+    return pairs // n_rows, pairs % n_rows
+
 def ckdnearest(gdf_a: geopandas.GeoDataFrame,
                gdf_b: geopandas.GeoDataFrame,
-               gdf_b_cols: List[str] = None
+               gdf_b_cols: List[str] = None,
+               segment_spacing: float = None,
+               k: int = 8,
+               chunk_size: int = 100_000,
+               index = None
                ) -> geopandas.GeoDataFrame:
     """For each geometry in gdf_a, find the closest geometry in gdf_b using an KDTree.
 
+    By default only the vertices of gdf_b are indexed, which can match a point
+    in the middle of a long segment to the wrong geometry. When
+    `segment_spacing` is given, gdf_b is densified at that spacing before
+    indexing and the candidates found are refined with the exact
+    point-to-segment distance.
+
     Parameters
     ----------
     gdf_a : geopandas.GeoDataFrame
@@ -525,6 +1021,19 @@ def ckdnearest(gdf_a: geopandas.GeoDataFrame,
         Left dataframe.
     gdf_b_cols : List[str, ...], optional
         The columns to join from B to A. The default is ['Place'].
+    segment_spacing : float, optional
+        Maximum distance between two indexed vertices, in the units of the
+        CRS. Enables the segment accurate mode, gdf_a must then hold Points.
+        The default is None.
+    k : int, optional
+        Number of vertices retrieved per point in the segment accurate mode
+        before falling back to a radius search. The default is 8.
+    chunk_size : int, optional
+        Number of points queried at once, to keep memory bounded. The default
+        is 100 000.
+    index : index_cache.SpatialIndex, optional
+        Cached spatial index of gdf_b, used instead of building the KD-tree.
+        The default is None.
 
     Returns
     -------
@@ -537,26 +1046,54 @@ def ckdnearest(gdf_a: geopandas.GeoDataFrame,
         raise ValueError("Must provide at least one column name")
     if not isinstance(gdf_b_cols, (list, tuple, np.ndarray)):
         gdf_b_cols = [gdf_b_cols]
-    _a = np.concatenate(
-        [np.array(geom.coords) for geom in gdf_a.geometry.to_list()])
-    _b = [np.array(geom.coords) for geom in gdf_b.geometry.to_list()]
-    b_ix = tuple(itertools.chain.from_iterable(
-        [itertools.repeat(i, x) for i, x in enumerate(list(map(len, _b)))]))
-    _b = np.concatenate(_b)
-    ckd_tree = cKDTree(_b)
-    dist, idx = ckd_tree.query(_a, k=1)
-    idx = itemgetter(*idx)(b_ix)
+
+    geoms_b = _as_geometry_array(gdf_b.geometry.values)
+    _a = shapely.get_coordinates(gdf_a.geometry.values)
+    if index is not None:
+        ckd_tree, b_ix = index.kdtree(segment_spacing)
+    else:
+        if segment_spacing is not None:
+            geoms_b_idx = shapely.segmentize(geoms_b, segment_spacing)
+        else:
+            geoms_b_idx = geoms_b
+        _b, b_ix = shapely.get_coordinates(geoms_b_idx, return_index=True)
+        b_ix = b_ix.astype(np.int32)
+        ckd_tree = cKDTree(_b)
+
+    dist = np.empty(len(_a))
+    idx = np.empty(len(_a), dtype=np.int32)
+    for chunk in range(0, len(_a), chunk_size):
+        points_xy = _a[chunk:chunk+chunk_size]
+        if segment_spacing is None:
+            dist_c, idx_c = ckd_tree.query(points_xy, k=1)
+            dist[chunk:chunk+chunk_size] = dist_c
+            idx[chunk:chunk+chunk_size] = b_ix[idx_c]
+            continue
+
+        point_i, row_i = _segment_candidates(ckd_tree, points_xy, b_ix,
+                                             segment_spacing, k)
+        dist_c = shapely.distance(shapely.points(points_xy[point_i]), geoms_b[row_i])
+        nearest = argmin_per_group(dist_c, point_i)
+        dist[chunk + point_i[nearest]] = dist_c[nearest]
+        idx[chunk + point_i[nearest]] = row_i[nearest]
+
     gdf = pd.concat(
-        [gdf_a, gdf_b.loc[idx, gdf_b_cols].reset_index(drop=True),
+        [gdf_a, gdf_b.iloc[idx][gdf_b_cols].reset_index(drop=True),
          pd.Series(dist, name='dist')], axis=1)
     return gdf
 
 def rtreenearest(gdf_a: geopandas.GeoDataFrame,
                  gdf_b: geopandas.GeoDataFrame,
-                 gdf_b_cols: List[str] = None
+                 gdf_b_cols: List[str] = None,
+                 max_distance: float = None,
+                 index = None
                  ) -> geopandas.GeoDataFrame:
     """For each geometry in gdf_a, find the closest geometry in gdf_b using an Rtree.
 
+    All geometries of gdf_a are queried in a single call to the spatial index.
+    When several geometries of gdf_b are at the same distance, the one with the
+    shortest projected distance is kept (the first row of gdf_b on equality).
+
     Parameters
     ----------
     gdf_a : geopandas.GeoDataFrame
@@ -565,6 +1102,13 @@ def rtreenearest(gdf_a: geopandas.GeoDataFrame,
         Left dataframe.
     gdf_b_cols : List[str, ...], optional
         The columns to join from B to A. The default is ['ID'].
+    max_distance : float, optional
+        Maximum search distance, in the units of the CRS. Geometries of gdf_a
+        without any match in this radius get NaN values. The default is None,
+        meaning no limit.
+    index : index_cache.SpatialIndex, optional
+        Cached spatial index of gdf_b, whose STRtree is used instead of
+        gdf_b.sindex. The default is None.
 
     Returns
     -------
@@ -573,38 +1117,43 @@ def rtreenearest(gdf_a: geopandas.GeoDataFrame,
         proximity.
 
     """
-    #TODO : Optimize with pygeos rtree. It can retrieve all points in one call.
     if gdf_b_cols is None:
         raise ValueError("Must provide at least one column name")
     if not isinstance(gdf_b_cols, (list, tuple, np.ndarray)):
         gdf_b_cols = [gdf_b_cols]
 
-    idx = []
-    dist_l = []
-    for point in gdf_a.geometry.to_list():
-        road_i = gdf_b.sindex.nearest(point, return_all=True)[1]
-        roads = gdf_b.loc[road_i, 'geometry'].to_list()
-
-        dist = np.inf
-        id_nearest = 0
-
-        for j, road in enumerate(roads):
-            place_projected = road.interpolate(road.project(point))
-            vector = shapely.LineString([point, place_projected])
-            # plus coure distance de la place à la route
-
-            if vector.length < dist:
-                dist = vector.length
-                id_nearest = j
-
-        idx.append(road_i[id_nearest])
-        dist_l.append(dist)
+    points = _as_geometry_array(gdf_a.geometry.values)
+    if index is not None:
+        point_i, road_i = index.strtree().query_nearest(points, all_matches=True,
+                                                        max_distance=max_distance)
+    else:
+        point_i, road_i = gdf_b.sindex.nearest(points, return_all=True,
+                                               max_distance=max_distance)
+    # equal distances are resolved in favour of the first row of gdf_b
+    order = np.lexsort((road_i, point_i))
+    point_i, road_i = point_i[order], road_i[order]
+    roads = _as_geometry_array(gdf_b.geometry.values)[road_i]
+    points_i = points[point_i]
+
+    # plus courte distance de la place à la route
+    place_projected = shapely.line_interpolate_point(
+        roads, shapely.line_locate_point(roads, points_i)
+    )
+    dist = shapely.distance(points_i, place_projected)
+
+    nearest = argmin_per_group(dist, point_i)
+
+    idx = np.full(len(gdf_a), -1, dtype=np.int64)
+    idx[point_i[nearest]] = road_i[nearest]
+    dist_l = np.full(len(gdf_a), np.nan)
+    dist_l[point_i[nearest]] = dist[nearest]
 
     gdf = pd.concat([gdf_a,
-                     gdf_b.loc[idx, gdf_b_cols].reset_index(drop=True),
+                     gdf_b[gdf_b_cols].reset_index(drop=True).reindex(idx)
+                                      .reset_index(drop=True),
                      pd.Series(dist_l, name='dist')],
                     axis=1)
     return gdf
 
-vectorized_r_o_l = np.vectorize(multipointobject_left_or_right)
-vectorized_dist = np.vectorize(distance)
+vectorized_r_o_l = lines_left_or_right
+vectorized_dist = lines_distance
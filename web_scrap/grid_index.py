@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts a uniform grid spatial hash of the geobase segments, for
+snapping streams of points to the closest road.
+
+The grid is built once: every 2-points segment of the geobase is registered
+in the cells its bounding box overlaps. Cell contents are stored in a CSR
+layout over a dense array of cells, so finding the segments of a cell is a
+direct lookup. A query visits the cell of the point, then rings of
+neighbouring cells, and stops as soon as the best segment found is closer than
+any segment of the next ring could be. Results are the ones of
+`geom.rtreenearest`: same road, ties going to the first row.
+
+Usage :
+    grid = GridIndex.from_geodataframe(geobase, cell_size=50)
+    for batch in stream:
+        rows, dist = grid.nearest(batch_xy)
+"""
+from typing import Sequence, Tuple, List
+from numpy.typing import ArrayLike
+
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+
+import kernels
+from geom import concat_ranges
+from polylines import GEOBASE_ID_COLS, PolylineStore
+
+# above this number of cells, a larger cell size must be used
+MAX_CELLS = 50_000_000
+
+
+class GridIndex():
+    """Uniform grid spatial hash over the segments of a PolylineStore.
+
+    Attributes
+    ----------
+    store : PolylineStore
+        The indexed network.
+    cell_size : float
+        Side of the cells, in the units of the CRS.
+    origin : np.ndarray
+        Lower left corner of the grid.
+    nx, ny : int
+        Number of columns and rows of cells.
+    cell_offsets : np.ndarray[int64]
+        Segments of cell (gx, gy) are
+        cell_segs[cell_offsets[gx*ny + gy]:cell_offsets[gx*ny + gy + 1]].
+    cell_segs : np.ndarray[int64]
+        Segment of each cell entry.
+    """
+    def __init__(self, store:PolylineStore, cell_size:float=50.):
+        if cell_size <= 0:
+            raise ValueError(f'Expecting a positive cell size, received {cell_size}')
+        self.store = store
+        self.cell_size = float(cell_size)
+
+        self.starts_xy, self.ends_xy, part_i = store.vectors()
+        self.seg_row = store.part_row[part_i].astype(np.int64)
+
+        if store.coords.size:
+            self.origin = store.coords.min(axis=0)
+            self.nx, self.ny = (np.floor((store.coords.max(axis=0) - self.origin) /
+                                         self.cell_size).astype(np.int64) + 1)
+        else:
+            self.origin = np.zeros(2)
+            self.nx, self.ny = 0, 0
+        if self.nx * self.ny > MAX_CELLS:
+            raise ValueError(f'The grid would have {self.nx * self.ny} cells, '
+                             'use a larger cell size.')
+
+        # cells overlapped by the bounding box of each segment
+        low = self._cells(np.minimum(self.starts_xy, self.ends_xy))
+        high = self._cells(np.maximum(self.starts_xy, self.ends_xy))
+        width = high[:, 0] - low[:, 0] + 1
+        height = high[:, 1] - low[:, 1] + 1
+        n_cells = width * height
+        seg = np.repeat(np.arange(self.seg_row.size), n_cells)
+        rank = concat_ranges(np.zeros(n_cells.size, dtype=np.int64), n_cells)
+        gx = low[seg, 0] + rank // height[seg]
+        gy = low[seg, 1] + rank % height[seg]
+        cell = gx * self.ny + gy
+
+        # stable sort: segments of a cell stay in network order
+        order = np.argsort(cell, kind='stable')
+        self.cell_segs = seg[order]
+        self.cell_offsets = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        self.cell_offsets[1:] = np.cumsum(np.bincount(cell, minlength=self.nx * self.ny))
+
+    @classmethod
+    def from_geodataframe(cls, gdf:geopandas.GeoDataFrame, cell_size:float=50.,
+                          id_cols:Sequence[str]=GEOBASE_ID_COLS):
+        """Build the grid of a GeoDataFrame of LineStrings and
+        MultiLineStrings, see `PolylineStore.from_geodataframe`."""
+        return cls(PolylineStore.from_geodataframe(gdf, id_cols), cell_size)
+
+    @property
+    def nbytes(self)->int:
+        """Memory used by the grid arrays, the store excluded."""
+        return sum(arr.nbytes for arr in (self.starts_xy, self.ends_xy, self.seg_row,
+                                          self.cell_offsets, self.cell_segs))
+
+    def _cells(self, points_xy:np.ndarray)->np.ndarray:
+        return np.floor((points_xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def nearest(self, points_xy:ArrayLike, max_distance:float=None
+                )->Tuple[np.ndarray, np.ndarray]:
+        """Closest row of the network to each point.
+
+        Parameters
+        ----------
+        points_xy : ArrayLike
+            Array of shape (n, 2), in the CRS of the network.
+        max_distance : float, optional
+            Maximum search distance, in the units of the CRS. The default is
+            None, meaning no limit.
+
+        Returns
+        -------
+        rows, dist : np.ndarray[int64], np.ndarray[float]
+            rows is -1 and dist NaN for points without a road within
+            max_distance, or with NaN coordinates.
+        """
+        points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+        valid = ~np.isnan(points_xy).any(axis=1)
+
+        # rings needed to cover the grid from the cell of the point
+        cells = self._cells(np.nan_to_num(points_xy))
+        outside = np.maximum.reduce([np.zeros(len(cells), dtype=np.int64),
+                                     -cells[:, 0], cells[:, 0] - self.nx + 1,
+                                     -cells[:, 1], cells[:, 1] - self.ny + 1])
+        max_ring = max(self.nx, self.ny) + outside
+        if max_distance is not None:
+            max_ring = np.minimum(max_ring, int(np.ceil(max_distance / self.cell_size)))
+        if self.cell_segs.size == 0:
+            valid[:] = False
+        max_ring = np.where(valid, max_ring, -1)
+
+        rows, dist = kernels.grid_nearest(points_xy, self.origin, self.cell_size,
+                                          self.nx, self.ny, self.cell_offsets,
+                                          self.cell_segs, self.starts_xy, self.ends_xy,
+                                          self.seg_row, max_ring)
+        if max_distance is not None:
+            too_far = ~(dist <= max_distance)
+            rows[too_far] = -1
+            dist[too_far] = np.nan
+        return rows, dist
+
+
+def gridnearest(gdf_a:geopandas.GeoDataFrame,
+                gdf_b:geopandas.GeoDataFrame,
+                gdf_b_cols:List[str]=None,
+                max_distance:float=None,
+                grid:GridIndex=None,
+                cell_size:float=50.
+                )->geopandas.GeoDataFrame:
+    """For each point in gdf_a, find the closest geometry in gdf_b using a
+    uniform grid. Drop-in replacement of `geom.rtreenearest` for Points.
+
+    Parameters
+    ----------
+    gdf_a : geopandas.GeoDataFrame
+        Right dataframe, made of Points.
+    gdf_b : geopandas.GeoDataFrame
+        Left dataframe, made of LineStrings and MultiLineStrings.
+    gdf_b_cols : List[str, ...], optional
+        The columns to join from B to A.
+    max_distance : float, optional
+        Maximum search distance, in the units of the CRS. Points without any
+        match in this radius get NaN values. The default is None, meaning no
+        limit.
+    grid : GridIndex, optional
+        Grid of gdf_b, built once and reused between calls. The default is
+        None, meaning it is built here.
+    cell_size : float, optional
+        Side of the cells when the grid is built here, in the units of the
+        CRS. The default is 50.
+
+    Returns
+    -------
+    gdf : geopandas.GeoDataFrame
+        Returns gdf_a enriched with columns from gdf_b and dist.
+    """
+    if gdf_b_cols is None:
+        raise ValueError("Must provide at least one column name")
+    if not isinstance(gdf_b_cols, (list, tuple, np.ndarray)):
+        gdf_b_cols = [gdf_b_cols]
+    if grid is None:
+        grid = GridIndex.from_geodataframe(gdf_b, cell_size=cell_size, id_cols=())
+
+    points = np.asarray(gdf_a.geometry.values, dtype=object)
+    points_xy = np.full((len(points), 2), np.nan)
+    not_empty = ~shapely.is_missing(points) & ~shapely.is_empty(points)
+    points_xy[not_empty] = shapely.get_coordinates(points[not_empty])
+    rows, dist = grid.nearest(points_xy, max_distance=max_distance)
+
+    gdf = pd.concat([gdf_a,
+                     gdf_b[gdf_b_cols].reset_index(drop=True).reindex(rows)
+                                      .reset_index(drop=True),
+                     pd.Series(dist, name='dist')],
+                    axis=1)
+    return gdf
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts a persistent cache of the geobase spatial indexes.
+
+The flattened coordinates of the geobase (see `polylines.PolylineStore`) and
+the inputs of its KD-trees are saved as `.npy` files in a directory named
+after a hash of the geobase. Warm runs memory-map those files instead of
+recomputing them, so several processes opening the same index share it
+through the OS page cache.
+
+Hashing the geobase needs it loaded, so callers that read it from a file
+should key the cache on the file instead (`source_key`) and pass a loader :
+a warm open then only memory-maps the arrays.
+
+Usage :
+    index = open_spatial_index(lambda: read_reprojected(path, crs),
+                               key=source_key(path, crs))
+    index = open_spatial_index(geobase)
+    gdf = ckdnearest(points, geobase, 'ID_TRC', index=index)
+"""
+import os
+import hashlib
+import tempfile
+from typing import Callable, Dict, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+import pyproj
+from scipy.spatial import cKDTree
+
+from polylines import GEOBASE_ID_COLS, PolylineStore
+
+DEFAULT_CACHE_DIR = os.path.join('cache', 'spatial_index')
+# CRS of the cached coordinates, as WKT
+CRS_FILE = 'crs.wkt'
+
+
+def geobase_key(gdf:geopandas.GeoDataFrame,
+                id_cols:Sequence[str]=GEOBASE_ID_COLS)->str:
+    """Hash the content of a geobase: CRS, geometries and identifier columns.
+
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame
+        The geobase.
+    id_cols : Sequence[str], optional
+        The identifier columns to include, when present. The default is
+        ('ID_TRC', 'COTE_RUE_ID').
+
+    Returns
+    -------
+    key : str
+    """
+    sha = hashlib.sha1()
+    sha.update(str(gdf.crs).encode())
+    sha.update(b''.join(shapely.to_wkb(np.asarray(gdf.geometry.values, dtype=object))))
+    for col in id_cols:
+        if col in gdf.columns:
+            sha.update(col.encode())
+            sha.update(pd.util.hash_array(gdf[col].to_numpy()).tobytes())
+    return sha.hexdigest()
+
+def source_key(path:str, crs=None,
+               id_cols:Sequence[str]=GEOBASE_ID_COLS)->str:
+    """Key of a geobase read from a file, from the file path, size and
+    modification time, without reading it.
+
+    Parameters
+    ----------
+    path : str
+        The geobase file.
+    crs : optional
+        The CRS the geobase is reprojected to after reading, anything
+        accepted by pyproj.CRS. The default is None, meaning as read.
+    id_cols : Sequence[str], optional
+        The identifier columns kept in the index. The default is
+        ('ID_TRC', 'COTE_RUE_ID').
+
+    Returns
+    -------
+    key : str
+    """
+    stat = os.stat(path)
+    sha = hashlib.sha1()
+    sha.update(os.path.abspath(path).encode())
+    sha.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    sha.update(str(crs).encode())
+    sha.update(','.join(id_cols).encode())
+    return sha.hexdigest()
+
+def _save_array(path:str, name:str, array:np.ndarray)->None:
+    """Atomically save an array, so that concurrent readers never see a
+    partially written file."""
+    fd, tmp_name = tempfile.mkstemp(dir=path, suffix='.npy.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp_name, os.path.join(path, name + '.npy'))
+
+def _load_array(path:str, name:str)->np.ndarray:
+    return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+def _kd_name(spacing:float=None)->str:
+    return 'kd_vertex' if spacing is None else f'kd_seg_{spacing:g}'
+
+
+class SpatialIndex():
+    """Spatial indexes of a geobase, backed by memory-mapped arrays.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the cached arrays.
+    store : PolylineStore
+        The flattened geobase.
+    """
+    def __init__(self, path:str, store:PolylineStore):
+        self.path = path
+        self.store = store
+        self._kdtrees: Dict[str, Tuple[cKDTree, np.ndarray]] = {}
+        self._geometries = None
+        self._strtree = None
+
+    @classmethod
+    def open(cls, path:str):
+        """Open an index saved with `save_store`."""
+        ids = {name[3:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+               for name in os.listdir(path)
+               if name.startswith('id_') and name.endswith('.npy')}
+        store = PolylineStore(_load_array(path, 'coords'),
+                              _load_array(path, 'offsets'),
+                              _load_array(path, 'row_offsets'),
+                              ids=ids)
+        crs_path = os.path.join(path, CRS_FILE)
+        if os.path.exists(crs_path):
+            with open(crs_path, encoding='utf-8') as f:
+                store.crs = pyproj.CRS.from_wkt(f.read())
+        return cls(path, store)
+
+    @staticmethod
+    def save_store(path:str, store:PolylineStore)->None:
+        """Save the arrays of a PolylineStore in path. row_offsets is written
+        last and marks the index as complete."""
+        os.makedirs(path, exist_ok=True)
+        if store.crs is not None:
+            fd, tmp_name = tempfile.mkstemp(dir=path, suffix='.wkt.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(pyproj.CRS.from_user_input(store.crs).to_wkt())
+            os.replace(tmp_name, os.path.join(path, CRS_FILE))
+        for name, values in store.ids.items():
+            if values.dtype.kind not in 'iuf':
+                values = values.astype(str)
+            _save_array(path, 'id_' + name, values)
+        _save_array(path, 'coords', store.coords)
+        _save_array(path, 'offsets', store.offsets)
+        _save_array(path, 'row_offsets', store.row_offsets)
+
+    def geometries(self)->np.ndarray:
+        """The geobase geometries, rebuilt once from the cached arrays."""
+        if self._geometries is None:
+            self._geometries = self.store.geometries()
+        return self._geometries
+
+    def strtree(self)->shapely.STRtree:
+        """STRtree of the geobase, rows are in the geobase order."""
+        if self._strtree is None:
+            self._strtree = shapely.STRtree(self.geometries())
+        return self._strtree
+
+    def kd_inputs(self, spacing:float=None)->Tuple[np.ndarray, np.ndarray]:
+        """Vertices indexed by the KD-tree of `geom.ckdnearest` and their row.
+
+        Parameters
+        ----------
+        spacing : float, optional
+            Densification spacing, see `geom.ckdnearest`. The default is None,
+            meaning the vertices of the geobase.
+
+        Returns
+        -------
+        coords, rows : np.ndarray, np.ndarray[int32]
+        """
+        name = _kd_name(spacing)
+        if not os.path.exists(os.path.join(self.path, name + '_rows.npy')):
+            geoms = self.geometries()
+            if spacing is not None:
+                geoms = shapely.segmentize(geoms, spacing)
+            coords, rows = shapely.get_coordinates(geoms, return_index=True)
+            _save_array(self.path, name + '_coords', coords)
+            _save_array(self.path, name + '_rows', rows.astype(np.int32))
+
+        return _load_array(self.path, name + '_coords'), _load_array(self.path, name + '_rows')
+
+    def kdtree(self, spacing:float=None)->Tuple[cKDTree, np.ndarray]:
+        """KD-tree over `kd_inputs(spacing)` and the row of each vertex."""
+        name = _kd_name(spacing)
+        if name not in self._kdtrees:
+            coords, rows = self.kd_inputs(spacing)
+            self._kdtrees[name] = (cKDTree(coords), rows)
+        return self._kdtrees[name]
+
+
+def open_spatial_index(gdf:Union[geopandas.GeoDataFrame,
+                                 Callable[[], geopandas.GeoDataFrame]],
+                       cache_dir:str=DEFAULT_CACHE_DIR,
+                       key:str=None,
+                       id_cols:Sequence[str]=GEOBASE_ID_COLS
+                       )->SpatialIndex:
+    """Open the cached spatial index of a geobase, building it on first use.
+
+    Passing `key` is the fast path : a warm open then neither loads nor
+    hashes the geobase and takes milliseconds. Without it, the whole
+    geobase is hashed with `geobase_key` on every call.
+
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame or callable
+        The geobase, or a function without arguments returning it, called
+        only when the index has to be built. The index rows follow its row
+        order.
+    cache_dir : str, optional
+        Root directory of the cache. The default is 'cache/spatial_index'.
+    key : str, optional
+        Cache key, ie `source_key(path, crs)` for a geobase read from a
+        file. The default is None, meaning `geobase_key(gdf, id_cols)`.
+    id_cols : Sequence[str], optional
+        The identifier columns to keep, when present. The default is
+        ('ID_TRC', 'COTE_RUE_ID').
+
+    Returns
+    -------
+    SpatialIndex
+    """
+    if key is None:
+        if callable(gdf):
+            gdf = gdf()
+        key = geobase_key(gdf, id_cols)
+    path = os.path.join(cache_dir, key)
+
+    if not os.path.exists(os.path.join(path, 'row_offsets.npy')):
+        if callable(gdf):
+            gdf = gdf()
+        SpatialIndex.save_store(path, PolylineStore.from_geodataframe(gdf, id_cols))
+
+    index = SpatialIndex.open(path)
+    if index.store.crs is None and not callable(gdf):
+        # cached before the CRS was saved with the arrays
+        index.store.crs = gdf.crs
+    return index
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts the inner loops of the geometric calculations of `geom`.
+
+When numba is installed, the kernels are JIT compiled, otherwise their NumPy
+versions are used. Both backends perform the same floating point operations
+in the same order and return identical results. The backend is selected at
+import time and exposed in BACKEND. Setting the environment variable
+GEOM_KERNELS to 'numpy' forces the NumPy backend.
+
+Kernels run on a single thread: callers parallelize them with process pools,
+and forking a process that runs numba worker threads can hang it.
+
+All kernels take arrays of shape (n, 2) for coordinates.
+"""
+import os
+from typing import Tuple
+
+import numpy as np
+
+
+def _cross_sign_numpy(a_xy:np.ndarray, b_xy:np.ndarray, p_xy:np.ndarray)->np.ndarray:
+    result = (p_xy[:, 0] - a_xy[:, 0]) * (b_xy[:, 1] - a_xy[:, 1]) - \
+             (p_xy[:, 1] - a_xy[:, 1]) * (b_xy[:, 0] - a_xy[:, 0])
+    return np.sign(np.nan_to_num(result, nan=0.)).astype(np.int8)
+
+def _segments_projection_numpy(points_xy:np.ndarray, starts_xy:np.ndarray,
+                               ends_xy:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    d_xy = ends_xy - starts_xy
+    length_2 = d_xy[:, 0]*d_xy[:, 0] + d_xy[:, 1]*d_xy[:, 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = ((points_xy[:, 0] - starts_xy[:, 0]) * d_xy[:, 0] +
+                 (points_xy[:, 1] - starts_xy[:, 1]) * d_xy[:, 1]) / length_2
+    ratio = np.clip(np.nan_to_num(ratio, nan=0.), 0, 1)
+
+    proj_x = starts_xy[:, 0] + ratio * d_xy[:, 0]
+    proj_y = starts_xy[:, 1] + ratio * d_xy[:, 1]
+    dist = np.sqrt((points_xy[:, 0] - proj_x)*(points_xy[:, 0] - proj_x) +
+                   (points_xy[:, 1] - proj_y)*(points_xy[:, 1] - proj_y))
+    return dist, ratio
+
+def _group_argmin_numpy(values:np.ndarray, starts:np.ndarray,
+                        counts:np.ndarray)->np.ndarray:
+    groups = np.repeat(np.arange(counts.size), counts)
+    # stable sort: on equal values the first one wins, NaN are sorted last
+    return np.lexsort((values, groups))[starts]
+
+def _ring(radius:int)->Tuple[np.ndarray, np.ndarray]:
+    """Cell offsets (dx, dy) at Chebyshev distance radius of a cell."""
+    side = np.arange(-radius, radius + 1)
+    if radius == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    inner = side[1:-1]
+    dx = np.concatenate([np.full(side.size, -radius), np.full(side.size, radius),
+                         inner, inner])
+    dy = np.concatenate([side, side, np.full(inner.size, -radius),
+                         np.full(inner.size, radius)])
+    return dx, dy
+
+def _grid_nearest_numpy(points_xy:np.ndarray, origin:np.ndarray, cell_size:float,
+                        nx:int, ny:int, cell_offsets:np.ndarray, cell_segs:np.ndarray,
+                        starts_xy:np.ndarray, ends_xy:np.ndarray, seg_row:np.ndarray,
+                        max_ring:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    cell_xy = np.floor((np.nan_to_num(points_xy) - origin) / cell_size).astype(np.int64)
+    cx, cy = cell_xy[:, 0], cell_xy[:, 1]
+    best_row = np.full(len(points_xy), -1, dtype=np.int64)
+    best_dist = np.full(len(points_xy), np.inf)
+
+    active = np.flatnonzero(max_ring >= 0)
+    radius = 0
+    while active.size:
+        dx, dy = _ring(radius)
+        point_i = np.repeat(active, dx.size)
+        gx = cx[point_i] + np.tile(dx, active.size)
+        gy = cy[point_i] + np.tile(dy, active.size)
+        inside = (gx >= 0) & (gx < nx) & (gy >= 0) & (gy < ny)
+        point_i, cell = point_i[inside], gx[inside] * ny + gy[inside]
+
+        counts = cell_offsets[cell + 1] - cell_offsets[cell]
+        ends = np.cumsum(counts)
+        seg = cell_segs[np.repeat(cell_offsets[cell] - ends + counts, counts) +
+                        np.arange(ends[-1] if ends.size else 0)]
+        point_i = np.repeat(point_i, counts)
+        dist, _ = _segments_projection_numpy(points_xy[point_i], starts_xy[seg], ends_xy[seg])
+
+        # the current best competes with the segments of the ring
+        point_i = np.concatenate([active, point_i])
+        dist = np.concatenate([best_dist[active], dist])
+        row = np.concatenate([best_row[active], seg_row[seg]])
+        order = np.lexsort((row, dist, point_i))
+        first = order[np.searchsorted(point_i[order], active)]
+        best_dist[active], best_row[active] = dist[first], row[first]
+
+        # unseen segments are at least radius cells away
+        done = (best_dist[active] < radius * cell_size) | (radius >= max_ring[active])
+        active = active[~done]
+        radius += 1
+
+    return best_row, np.where(best_row >= 0, best_dist, np.nan)
+
+
+try:
+    if os.environ.get('GEOM_KERNELS', '').lower() == 'numpy':
+        raise ImportError('NumPy backend forced by GEOM_KERNELS')
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _cross_sign_numba(a_xy, b_xy, p_xy):
+        result = np.empty(p_xy.shape[0], dtype=np.int8)
+        for i in range(p_xy.shape[0]):
+            cross = (p_xy[i, 0] - a_xy[i, 0]) * (b_xy[i, 1] - a_xy[i, 1]) - \
+                    (p_xy[i, 1] - a_xy[i, 1]) * (b_xy[i, 0] - a_xy[i, 0])
+            if cross > 0:
+                result[i] = 1
+            elif cross < 0:
+                result[i] = -1
+            else:
+                result[i] = 0
+        return result
+
+    @numba.njit(cache=True)
+    def _segments_projection_numba(points_xy, starts_xy, ends_xy):
+        dist = np.empty(points_xy.shape[0])
+        ratio = np.empty(points_xy.shape[0])
+        for i in range(points_xy.shape[0]):
+            d_x = ends_xy[i, 0] - starts_xy[i, 0]
+            d_y = ends_xy[i, 1] - starts_xy[i, 1]
+            length_2 = d_x*d_x + d_y*d_y
+            if length_2 == 0:
+                ratio_i = np.nan
+            else:
+                ratio_i = ((points_xy[i, 0] - starts_xy[i, 0]) * d_x +
+                           (points_xy[i, 1] - starts_xy[i, 1]) * d_y) / length_2
+            if np.isnan(ratio_i) or ratio_i < 0:
+                ratio_i = 0.
+            elif ratio_i > 1:
+                ratio_i = 1.
+
+            proj_x = starts_xy[i, 0] + ratio_i * d_x
+            proj_y = starts_xy[i, 1] + ratio_i * d_y
+            dist[i] = np.sqrt((points_xy[i, 0] - proj_x)*(points_xy[i, 0] - proj_x) +
+                              (points_xy[i, 1] - proj_y)*(points_xy[i, 1] - proj_y))
+            ratio[i] = ratio_i
+        return dist, ratio
+
+    @numba.njit(cache=True)
+    def _group_argmin_numba(values, starts, counts):
+        result = np.empty(starts.shape[0], dtype=np.int64)
+        for group in range(starts.shape[0]):
+            best = starts[group]
+            best_value = values[best]
+            for j in range(starts[group] + 1, starts[group] + counts[group]):
+                if values[j] < best_value or (np.isnan(best_value) and not np.isnan(values[j])):
+                    best = j
+                    best_value = values[j]
+            result[group] = best
+        return result
+
+    @numba.njit(cache=True)
+    def _grid_nearest_numba(points_xy, origin, cell_size, nx, ny, cell_offsets,
+                            cell_segs, starts_xy, ends_xy, seg_row, max_ring):
+        best_row = np.full(points_xy.shape[0], -1, dtype=np.int64)
+        best_dist = np.full(points_xy.shape[0], np.nan)
+        for i in range(points_xy.shape[0]):
+            if max_ring[i] < 0:
+                continue
+            cx = np.int64(np.floor((points_xy[i, 0] - origin[0]) / cell_size))
+            cy = np.int64(np.floor((points_xy[i, 1] - origin[1]) / cell_size))
+            row_i = -1
+            dist_i = np.inf
+            for radius in range(max_ring[i] + 1):
+                for gx in range(cx - radius, cx + radius + 1):
+                    if gx < 0 or gx >= nx:
+                        continue
+                    # only the first and last column of the ring are full
+                    step = 1 if gx == cx - radius or gx == cx + radius else 2 * radius
+                    for gy in range(cy - radius, cy + radius + 1, step):
+                        if gy < 0 or gy >= ny:
+                            continue
+                        cell = gx * ny + gy
+                        for j in range(cell_offsets[cell], cell_offsets[cell + 1]):
+                            seg = cell_segs[j]
+                            d_x = ends_xy[seg, 0] - starts_xy[seg, 0]
+                            d_y = ends_xy[seg, 1] - starts_xy[seg, 1]
+                            length_2 = d_x*d_x + d_y*d_y
+                            if length_2 == 0:
+                                ratio = np.nan
+                            else:
+                                ratio = ((points_xy[i, 0] - starts_xy[seg, 0]) * d_x +
+                                         (points_xy[i, 1] - starts_xy[seg, 1]) * d_y) / length_2
+                            if np.isnan(ratio) or ratio < 0:
+                                ratio = 0.
+                            elif ratio > 1:
+                                ratio = 1.
+                            proj_x = starts_xy[seg, 0] + ratio * d_x
+                            proj_y = starts_xy[seg, 1] + ratio * d_y
+                            dist = np.sqrt((points_xy[i, 0] - proj_x)*(points_xy[i, 0] - proj_x) +
+                                           (points_xy[i, 1] - proj_y)*(points_xy[i, 1] - proj_y))
+                            if dist < dist_i or (dist == dist_i and seg_row[seg] < row_i):
+                                dist_i = dist
+                                row_i = seg_row[seg]
+                # unseen segments are at least radius cells away
+                if dist_i < radius * cell_size:
+                    break
+            if row_i >= 0:
+                best_row[i] = row_i
+                best_dist[i] = dist_i
+        return best_row, best_dist
+
+    BACKEND = 'numba'
+    _cross_sign, _segments_projection, _group_argmin, _grid_nearest = \
+        _cross_sign_numba, _segments_projection_numba, _group_argmin_numba, \
+        _grid_nearest_numba
+else:
+    BACKEND = 'numpy'
+    _cross_sign, _segments_projection, _group_argmin, _grid_nearest = \
+        _cross_sign_numpy, _segments_projection_numpy, _group_argmin_numpy, \
+        _grid_nearest_numpy
+
+
+def _coords(array:np.ndarray)->np.ndarray:
+    return np.ascontiguousarray(array, dtype=np.float64).reshape(-1, 2)
+
+def cross_sign(a_xy:np.ndarray, b_xy:np.ndarray, p_xy:np.ndarray)->np.ndarray:
+    """Sign of the cross product of the vectors (a, b) and (a, p): 1 when p is
+    to the right of (a, b), -1 to the left and 0 on the line."""
+    return _cross_sign(_coords(a_xy), _coords(b_xy), _coords(p_xy))
+
+def segments_projection(points_xy:np.ndarray, starts_xy:np.ndarray,
+                        ends_xy:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    """Euclidean distance between each point and its projection on the
+    matching segment, and the position of the projection on the segment,
+    between 0 (start) and 1 (end)."""
+    return _segments_projection(_coords(points_xy), _coords(starts_xy), _coords(ends_xy))
+
+def group_argmin(values:np.ndarray, starts:np.ndarray, counts:np.ndarray)->np.ndarray:
+    """Position of the minimum of each group of consecutive values, group i
+    being values[starts[i]:starts[i]+counts[i]]. Groups must not be empty. On
+    equal values the first one is kept, NaN values are only kept when the
+    whole group is NaN."""
+    return _group_argmin(np.ascontiguousarray(values, dtype=np.float64),
+                         np.ascontiguousarray(starts, dtype=np.int64),
+                         np.ascontiguousarray(counts, dtype=np.int64))
+
+def grid_nearest(points_xy:np.ndarray, origin:np.ndarray, cell_size:float,
+                 nx:int, ny:int, cell_offsets:np.ndarray, cell_segs:np.ndarray,
+                 starts_xy:np.ndarray, ends_xy:np.ndarray, seg_row:np.ndarray,
+                 max_ring:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+    """Nearest segment row of each point in a uniform grid of nx by ny cells,
+    searching rings of cells around the cell of the point, up to max_ring[i]
+    rings (none when negative). Segments of cell (gx, gy) are
+    cell_segs[cell_offsets[gx*ny + gy]:cell_offsets[gx*ny + gy + 1]]. On equal
+    distances the lowest row is kept.
+
+    Returns
+    -------
+    rows, dist
+        rows is -1 and dist NaN when nothing was found.
+    """
+    return _grid_nearest(_coords(points_xy), np.ascontiguousarray(origin, dtype=np.float64),
+                         float(cell_size), int(nx), int(ny),
+                         np.ascontiguousarray(cell_offsets, dtype=np.int64),
+                         np.ascontiguousarray(cell_segs, dtype=np.int64),
+                         _coords(starts_xy), _coords(ends_xy),
+                         np.ascontiguousarray(seg_row, dtype=np.int64),
+                         np.ascontiguousarray(max_ring, dtype=np.int64))
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts a parallel, tile partitioned version of the nearest road
+joins of `geom`.
+
+Query points are split into square tiles. Each tile is sent to a worker
+process with the rows of the road network that intersect the tile expanded
+by a halo. Road coordinates and query points are shared with the workers
+through shared memory, only row and point indices are pickled.
+
+A match found at a distance up to the halo is exact, since every road within
+the halo of the tile is part of the tile candidates. Points whose nearest
+road in the tile is farther than the halo are recomputed on the whole
+network, so results are identical to the serial functions.
+
+Usage :
+    gdf = parallel_nearest(points, geobase, 'ID_TRC', n_workers=8)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+
+from geom import ckdnearest, lines_left_or_right, rtreenearest
+from polylines import PolylineStore
+
+# shared arrays attached by each worker, see _init_worker
+_SHARED: Dict[str, np.ndarray] = {}
+_SHARED_MEMORY: List[shared_memory.SharedMemory] = []
+
+
+def _to_shared(arrays:Dict[str, np.ndarray]
+               )->Tuple[List[shared_memory.SharedMemory], Dict[str, tuple]]:
+    """Copy arrays into new shared memory blocks.
+
+    Returns
+    -------
+    blocks, specs
+        The blocks, to close and unlink once done, and the (name, shape,
+        dtype) needed by the workers to attach them.
+    """
+    blocks = []
+    specs = {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[key] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _init_worker(specs:Dict[str, tuple])->None:
+    """Attach the shared arrays in a worker process."""
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _SHARED_MEMORY.append(block)
+        _SHARED[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _nearest_tile(task:tuple)->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Nearest road of the points of one tile, among the tile road rows.
+
+    Returns
+    -------
+    rows, dist, side
+        rows is -1 and dist NaN where no road was found within the halo.
+    """
+    point_idx, road_rows, method, halo, params = task
+    if road_rows.size == 0:
+        return (np.full(point_idx.size, -1, dtype=np.int64),
+                np.full(point_idx.size, np.nan),
+                np.zeros(point_idx.size, dtype=np.int8))
+
+    store = PolylineStore(_SHARED['coords'], _SHARED['offsets'], _SHARED['row_offsets'])
+
+    gdf_a = geopandas.GeoDataFrame(geometry=shapely.points(_SHARED['points'][point_idx]))
+    gdf_b = geopandas.GeoDataFrame({'row': road_rows},
+                                   geometry=store.geometries(road_rows))
+
+    return _nearest(gdf_a, gdf_b, method, halo, params)
+
+def _nearest(gdf_a:geopandas.GeoDataFrame, gdf_b:geopandas.GeoDataFrame,
+             method:str, max_distance:float, params:dict
+             )->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Run the serial nearest join of `method` and the side of street.
+
+    gdf_b must have a 'row' column holding the global row of each road.
+    """
+    if method == 'rtree':
+        res = rtreenearest(gdf_a, gdf_b, 'row', max_distance=max_distance)
+    else:
+        res = ckdnearest(gdf_a, gdf_b, 'row', segment_spacing=params['segment_spacing'],
+                         k=params['k'])
+
+    dist = res['dist'].to_numpy(dtype=float)
+    found = dist <= max_distance if max_distance is not None else ~np.isnan(dist)
+    rows = np.where(found, res['row'].fillna(-1).to_numpy(), -1).astype(np.int64)
+
+    side = np.zeros(len(gdf_a), dtype=np.int8)
+    if params['side_of_street']:
+        local = pd.Index(gdf_b['row']).get_indexer(rows[found])
+        side[found] = lines_left_or_right(
+            np.asarray(gdf_b.geometry.values, dtype=object)[local],
+            np.asarray(gdf_a.geometry.values, dtype=object)[found],
+            great_circle=params['great_circle']
+        )
+
+    return rows, np.where(found, dist, np.nan), side
+
+def _tiles(points_xy:np.ndarray, tile_size:float)->List[np.ndarray]:
+    """Split points into square tiles of side tile_size."""
+    cells = np.floor((points_xy - points_xy.min(axis=0)) / tile_size).astype(np.int64)
+    _, tile_i = np.unique(cells, axis=0, return_inverse=True)
+    tile_i = tile_i.ravel()
+    order = np.argsort(tile_i, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(tile_i[order])) + 1)
+
+def parallel_nearest(gdf_a:geopandas.GeoDataFrame,
+                     gdf_b:geopandas.GeoDataFrame,
+                     gdf_b_cols:List[str]=None,
+                     method:str='rtree',
+                     n_workers:int=None,
+                     tile_size:float=1000.,
+                     halo:float=100.,
+                     side_of_street:bool=False,
+                     great_circle:bool=False,
+                     segment_spacing:float=None,
+                     k:int=8
+                     )->geopandas.GeoDataFrame:
+    """For each point in gdf_a, find the closest geometry in gdf_b with a pool
+    of processes. Results are identical to `geom.rtreenearest` and
+    `geom.ckdnearest`.
+
+    Parameters
+    ----------
+    gdf_a : geopandas.GeoDataFrame
+        Right dataframe, made of Points.
+    gdf_b : geopandas.GeoDataFrame
+        Left dataframe, made of LineStrings and MultiLineStrings.
+    gdf_b_cols : List[str, ...], optional
+        The columns to join from B to A.
+    method : str, optional
+        'rtree' for `geom.rtreenearest` or 'ckd' for the segment accurate mode
+        of `geom.ckdnearest`. The default is 'rtree'.
+    n_workers : int, optional
+        Number of worker processes. The default is None, meaning the number
+        of CPUs.
+    tile_size : float, optional
+        Side of the tiles, in the units of the CRS. The default is 1000.
+    halo : float, optional
+        Margin added around each tile to select its roads, in the units of the
+        CRS. It should exceed the usual distance between a point and its road.
+        The default is 100.
+    side_of_street : bool, optional
+        If True, also compute the side_of_street column with
+        `geom.lines_left_or_right`. The default is False.
+    great_circle : bool, optional
+        See `geom.lines_left_or_right`. The default is False, since gdf_a and
+        gdf_b are expected to be in a projected CRS.
+    segment_spacing : float, optional
+        See `geom.ckdnearest`, required by the 'ckd' method.
+    k : int, optional
+        See `geom.ckdnearest`. The default is 8.
+
+    Raises
+    ------
+    ValueError
+        Unknown method, or 'ckd' without segment_spacing. The vertex mode of
+        ckdnearest resolves ties between shared vertices in tree order, which
+        changes with the tile, so it is not supported.
+
+    Returns
+    -------
+    gdf : geopandas.GeoDataFrame
+        Returns gdf_a enriched with columns from gdf_b, dist and optionally
+        side_of_street.
+    """
+    if gdf_b_cols is None:
+        raise ValueError("Must provide at least one column name")
+    if not isinstance(gdf_b_cols, (list, tuple, np.ndarray)):
+        gdf_b_cols = [gdf_b_cols]
+    if method not in ('rtree', 'ckd'):
+        raise ValueError(f"Expecting 'rtree' or 'ckd', received {method}")
+    if method == 'ckd' and segment_spacing is None:
+        raise ValueError("The 'ckd' method requires a segment_spacing.")
+
+    params = {'segment_spacing': segment_spacing, 'k': k,
+              'side_of_street': side_of_street, 'great_circle': great_circle}
+
+    points_xy = shapely.get_coordinates(gdf_a.geometry.values)
+    store = PolylineStore.from_geodataframe(gdf_b, id_cols=())
+    tree = shapely.STRtree(np.asarray(gdf_b.geometry.values, dtype=object))
+
+    tasks = []
+    for point_idx in _tiles(points_xy, tile_size) if len(points_xy) else []:
+        minx, miny = points_xy[point_idx].min(axis=0)
+        maxx, maxy = points_xy[point_idx].max(axis=0)
+        road_rows = np.sort(tree.query(shapely.box(minx - halo, miny - halo,
+                                                   maxx + halo, maxy + halo)))
+        tasks.append((point_idx, road_rows, method, halo, params))
+
+    rows = np.full(len(gdf_a), -1, dtype=np.int64)
+    dist = np.full(len(gdf_a), np.nan)
+    side = np.zeros(len(gdf_a), dtype=np.int8)
+
+    blocks, specs = _to_shared({'coords': store.coords, 'offsets': store.offsets,
+                                'row_offsets': store.row_offsets, 'points': points_xy})
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(),
+                                 initializer=_init_worker,
+                                 initargs=(specs,)) as pool:
+            for (point_idx, *_), (rows_t, dist_t, side_t) in zip(
+                    tasks, pool.map(_nearest_tile, tasks, chunksize=4)):
+                rows[point_idx], dist[point_idx], side[point_idx] = rows_t, dist_t, side_t
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # points without a road within the halo are done on the whole network
+    missing = np.flatnonzero(rows < 0)
+    if missing.size:
+        gdf_b_rows = geopandas.GeoDataFrame({'row': np.arange(len(gdf_b))},
+                                            geometry=gdf_b.geometry.values)
+        gdf_a_missing = geopandas.GeoDataFrame(
+            geometry=np.asarray(gdf_a.geometry.values, dtype=object)[missing]
+        )
+        rows_m, dist_m, side_m = _nearest(gdf_a_missing, gdf_b_rows, method,
+                                             None, params)
+        rows[missing], dist[missing], side[missing] = rows_m, dist_m, side_m
+
+    columns = [gdf_a,
+               gdf_b[gdf_b_cols].reset_index(drop=True).reindex(rows).reset_index(drop=True),
+               pd.Series(dist, name='dist')]
+    if side_of_street:
+        columns.append(pd.Series(side, name='side_of_street'))
+
+    return pd.concat(columns, axis=1)
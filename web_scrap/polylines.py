@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts a columnar representation of a road network.
+
+A PolylineStore keeps all the vertices of a network in one contiguous float64
+buffer, with offsets delimiting each line part and each row (road segment).
+It is built once from a GeoDataFrame and geometric operations are run on the
+whole network without creating one shapely object per segment.
+"""
+from typing import Dict, Sequence, Tuple
+from numpy.typing import ArrayLike
+
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+
+from geom import (
+    argmin_per_group,
+    concat_ranges,
+    polylines_left_or_right,
+    segments_projection,
+)
+
+GEOBASE_ID_COLS = ('ID_TRC', 'COTE_RUE_ID')
+
+
+class PolylineStore():
+    """Columnar storage of a network of LineStrings and MultiLineStrings.
+
+    Attributes
+    ----------
+    coords : np.ndarray
+        Array of shape (n_vertices, 2) with the vertices of every line part.
+    offsets : np.ndarray[int64]
+        Vertices of part i are coords[offsets[i]:offsets[i+1]].
+    row_offsets : np.ndarray[int64]
+        Parts of row j are offsets[row_offsets[j]:row_offsets[j+1]].
+    ids : Dict[str, np.ndarray]
+        Identifiers of each row (ID_TRC, COTE_RUE_ID, ...).
+    crs : pyproj.CRS
+        CRS of the coordinates.
+    """
+    def __init__(self, coords:ArrayLike, offsets:ArrayLike,
+                 row_offsets:ArrayLike, ids:Dict[str, ArrayLike]=None,
+                 crs=None):
+
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.row_offsets = np.asarray(row_offsets, dtype=np.int64)
+        self.ids = {} if ids is None else {name: np.asarray(values)
+                                           for name, values in ids.items()}
+        self.crs = crs
+
+        self.part_row = np.repeat(np.arange(len(self), dtype=np.int32),
+                                  np.diff(self.row_offsets))
+
+    @classmethod
+    def from_geodataframe(cls, gdf:geopandas.GeoDataFrame,
+                          id_cols:Sequence[str]=GEOBASE_ID_COLS):
+        """Build the store from a GeoDataFrame of LineStrings and
+        MultiLineStrings.
+
+        Parameters
+        ----------
+        gdf : geopandas.GeoDataFrame
+            The road network.
+        id_cols : Sequence[str], optional
+            The identifier columns to keep, when present. The default is
+            ('ID_TRC', 'COTE_RUE_ID').
+
+        Raises
+        ------
+        ValueError
+            The GeoDataFrame contains other geometries than lines.
+
+        Returns
+        -------
+        PolylineStore
+        """
+        geoms = np.asarray(gdf.geometry.values, dtype=object)
+        types = shapely.get_type_id(geoms)
+        lines = (types == shapely.GeometryType.LINESTRING) | \
+                (types == shapely.GeometryType.MULTILINESTRING) | \
+                (types == shapely.GeometryType.MISSING)
+        if not lines.all():
+            raise ValueError('Only LineString and MultiLineString are supported.')
+
+        parts, row_ix = shapely.get_parts(geoms, return_index=True)
+        coords, part_ix = shapely.get_coordinates(parts, return_index=True)
+
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(part_ix, minlength=len(parts)))
+        row_offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+        row_offsets[1:] = np.cumsum(np.bincount(row_ix, minlength=len(geoms)))
+
+        ids = {col: gdf[col].to_numpy() for col in id_cols if col in gdf.columns}
+
+        return cls(coords, offsets, row_offsets, ids=ids, crs=gdf.crs)
+
+    def __len__(self)->int:
+        return self.row_offsets.size - 1
+
+    @property
+    def n_parts(self)->int:
+        """Number of line parts in the network."""
+        return self.offsets.size - 1
+
+    @property
+    def nbytes(self)->int:
+        """Memory used by the arrays of the store."""
+        return sum(arr.nbytes for arr in (self.coords, self.offsets,
+                                          self.row_offsets, self.part_row,
+                                          *self.ids.values()))
+
+    def rows_of(self, values:ArrayLike, id_col:str='ID_TRC')->np.ndarray:
+        """Row positions of segment identifiers, -1 when not found."""
+        return pd.Index(self.ids[id_col]).get_indexer(np.asarray(values))
+
+    def parts_of(self, rows:ArrayLike)->Tuple[np.ndarray, np.ndarray]:
+        """Line parts of each row.
+
+        Returns
+        -------
+        query_i, part_i : np.ndarray[int], np.ndarray[int]
+            For each part, the position of its row in `rows` and its index.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = np.flatnonzero(rows >= 0)
+        counts = self.row_offsets[rows[valid] + 1] - self.row_offsets[rows[valid]]
+        return np.repeat(valid, counts), concat_ranges(self.row_offsets[rows[valid]], counts)
+
+    def vertices(self, parts:ArrayLike)->Tuple[np.ndarray, np.ndarray]:
+        """Coordinates of the vertices of some parts, one part after the other.
+
+        Returns
+        -------
+        coords, counts : np.ndarray, np.ndarray[int]
+            The vertices and their number for each part.
+        """
+        parts = np.asarray(parts, dtype=np.int64)
+        counts = self.offsets[parts + 1] - self.offsets[parts]
+        return self.coords[concat_ranges(self.offsets[parts], counts)], counts
+
+    def vectors(self)->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Every 2-points segment of the network, the array counterpart of
+        `geom.polyline_to_vectors`.
+
+        Returns
+        -------
+        starts_xy, ends_xy, part_i : np.ndarray, np.ndarray, np.ndarray[int]
+            First and last point of each segment and the part it belongs to.
+        """
+        first = concat_ranges(self.offsets[:-1], np.diff(self.offsets) - 1)
+        part_i = np.repeat(np.arange(self.n_parts), np.diff(self.offsets) - 1)
+        return self.coords[first], self.coords[first + 1], part_i
+
+    def lengths(self)->np.ndarray:
+        """Length of each row, in the units of the CRS."""
+        starts_xy, ends_xy, part_i = self.vectors()
+        seg_length = np.sqrt(((ends_xy - starts_xy)**2).sum(axis=1))
+        part_length = np.bincount(part_i, weights=seg_length, minlength=self.n_parts)
+        return np.bincount(self.part_row, weights=part_length, minlength=len(self))
+
+    def geometries(self, rows:ArrayLike=None)->np.ndarray:
+        """Rebuild shapely geometries, for export or interoperability.
+
+        Parameters
+        ----------
+        rows : ArrayLike[int], optional
+            The rows to rebuild. The default is None, meaning all rows.
+
+        Returns
+        -------
+        np.ndarray[shapely.LineString | shapely.MultiLineString]
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        query_i, part_i = self.parts_of(rows)
+        coords, counts = self.vertices(part_i)
+
+        result = np.full(rows.size, None, dtype=object)
+        if part_i.size == 0:
+            return result
+        lines = shapely.linestrings(coords, indices=np.repeat(np.arange(part_i.size), counts))
+
+        n_parts = np.bincount(query_i, minlength=rows.size)
+        single = n_parts[query_i] == 1
+        result[query_i[single]] = lines[single]
+        if not single.all():
+            multi, multi_i = np.unique(query_i[~single], return_inverse=True)
+            result[multi] = shapely.multilinestrings(lines[~single], indices=multi_i)
+        return result
+
+    def _closest_parts(self, points_xy:np.ndarray, rows:np.ndarray
+                       )->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Closest part of each row to the matching point (first one on equal
+        distances) and the distance to it.
+        """
+        query_i, part_i = self.parts_of(rows)
+        seg_counts = self.offsets[part_i + 1] - self.offsets[part_i] - 1
+        seg_start = concat_ranges(self.offsets[part_i], seg_counts)
+        seg_pair = np.repeat(np.arange(part_i.size), seg_counts)
+
+        seg_dist, _ = segments_projection(points_xy[query_i[seg_pair]],
+                                          self.coords[seg_start],
+                                          self.coords[seg_start + 1])
+        part_dist = np.minimum.reduceat(seg_dist, np.cumsum(seg_counts) - seg_counts) \
+                    if seg_dist.size else np.empty(0)
+
+        best = argmin_per_group(part_dist, query_i)
+        return query_i[best], part_i[best], part_dist[best]
+
+    def distance(self, points_xy:ArrayLike, rows:ArrayLike)->np.ndarray:
+        """Euclidean distance between each point and the row it is paired with.
+
+        Parameters
+        ----------
+        points_xy : ArrayLike
+            Array of shape (n, 2).
+        rows : ArrayLike[int]
+            Row of each point, -1 for none.
+
+        Returns
+        -------
+        dist : np.ndarray[float]
+            NaN for points without a row.
+        """
+        points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+        dist = np.full(len(points_xy), np.nan)
+        query_i, _, part_dist = self._closest_parts(points_xy, rows)
+        dist[query_i] = part_dist
+        return dist
+
+    def left_or_right(self, points_xy:ArrayLike, rows:ArrayLike)->np.ndarray:
+        """Side of the street of each point relatively to the row it is paired
+        with. Same rules as `geom.lines_left_or_right` with the euclidean
+        distance, so coordinates should be projected.
+
+        Parameters
+        ----------
+        points_xy : ArrayLike
+            Array of shape (n, 2).
+        rows : ArrayLike[int]
+            Row of each point, -1 for none.
+
+        Returns
+        -------
+        result: np.ndarray[int]
+            -1 for "left", 0 for "on the line" or no row, 1 for "right".
+        """
+        points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+        result = np.zeros(len(points_xy), dtype=np.int8)
+
+        query_i, part_i, part_dist = self._closest_parts(points_xy, rows)
+        off_line = part_dist > 0
+        query_i, part_i = query_i[off_line], part_i[off_line]
+        if query_i.size == 0:
+            return result
+
+        coords, counts = self.vertices(part_i)
+        result[query_i] = polylines_left_or_right(coords, counts, points_xy[query_i],
+                                                  great_circle=False)
+        return result
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+A module that hosts cached coordinate transformations.
+
+Creating a `pyproj.Transformer` is costly and reprojecting the whole geobase
+takes seconds, while the same few CRS pairs and the same geobase are used
+over and over. Transformers are cached by (source CRS, target CRS) and the
+reprojected copies of a geobase by (source, target CRS), the source being a
+file path or a hash of the frame content.
+
+Usage :
+    roads = read_reprojected('geobase.geojson', MONTREAL_CRS)
+    df = to_crs(df, MONTREAL_CRS)
+"""
+import os
+import functools
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import geopandas
+import shapely
+from pyproj import CRS, Transformer
+
+from index_cache import geobase_key
+
+# reprojected frames, by (source, target CRS)
+_REPROJECTED: Dict[Tuple[str, str], geopandas.GeoDataFrame] = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer(crs_from:CRS, crs_to:CRS)->Transformer:
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+def get_transformer(crs_from, crs_to)->Transformer:
+    """Cached transformer between two CRS, in (x, y) order (lon, lat for
+    geographic CRS, as shapely and geopandas).
+
+    Parameters
+    ----------
+    crs_from, crs_to : Any
+        Anything accepted by `pyproj.CRS.from_user_input`.
+
+    Returns
+    -------
+    pyproj.Transformer
+    """
+    return _transformer(CRS.from_user_input(crs_from), CRS.from_user_input(crs_to))
+
+def transform_xy(points_xy:np.ndarray, crs_from, crs_to)->np.ndarray:
+    """Reproject an array of coordinates of shape (n, 2)."""
+    points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+    x, y = get_transformer(crs_from, crs_to).transform(points_xy[:, 0], points_xy[:, 1])
+    return np.column_stack([x, y])
+
+def to_crs(gdf:geopandas.GeoDataFrame, crs)->geopandas.GeoDataFrame:
+    """Reproject a GeoDataFrame with a cached transformer. The frame is
+    returned as is when it is already in crs.
+
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame
+        Frame to reproject, its CRS must be set.
+    crs : Any
+        Target CRS, anything accepted by `pyproj.CRS.from_user_input`.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+    """
+    crs = CRS.from_user_input(crs)
+    if gdf.crs is None:
+        raise ValueError('Cannot transform naive geometries, set the CRS first.')
+    if gdf.crs == crs:
+        return gdf
+
+    transformer = get_transformer(gdf.crs, crs)
+    geoms = shapely.transform(np.asarray(gdf.geometry.values, dtype=object),
+                              lambda coords: np.column_stack(
+                                  transformer.transform(coords[:, 0], coords[:, 1])
+                              ))
+    gdf = gdf.copy()
+    gdf[gdf.geometry.name] = geopandas.GeoSeries(geoms, index=gdf.index, crs=crs)
+    return gdf.set_crs(crs, allow_override=True)
+
+def reprojected(gdf:geopandas.GeoDataFrame, crs, source:str=None
+                )->geopandas.GeoDataFrame:
+    """Reprojected copy of a frame, computed once per (source, CRS).
+
+    The returned frame is shared between callers and must not be modified in
+    place.
+
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame
+        Frame to reproject, usually the geobase.
+    crs : Any
+        Target CRS, anything accepted by `pyproj.CRS.from_user_input`.
+    source : str, optional
+        Identifier of gdf. The default is None, meaning a hash of its content
+        (see `index_cache.geobase_key`).
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+    """
+    crs = CRS.from_user_input(crs)
+    if source is None:
+        source = geobase_key(gdf)
+    key = (source, crs.to_wkt())
+    if key not in _REPROJECTED:
+        _REPROJECTED[key] = to_crs(gdf, crs)
+    return _REPROJECTED[key]
+
+def _file_key(path:str, crs:CRS, kwargs:dict)->Tuple[str, str]:
+    source = f'{os.path.abspath(path)}@{os.path.getmtime(path)}'
+    if kwargs:
+        source += repr(sorted(kwargs.items()))
+    return (source, crs.to_wkt())
+
+def read_reprojected(path:str, crs, **kwargs)->geopandas.GeoDataFrame:
+    """Read a file and reproject it, once per (path, modification time, CRS).
+
+    Parameters
+    ----------
+    path : str
+        File readable by `geopandas.read_file`.
+    crs : Any
+        Target CRS, anything accepted by `pyproj.CRS.from_user_input`.
+    **kwargs
+        Passed to `geopandas.read_file`.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        Shared between callers, must not be modified in place.
+    """
+    crs = CRS.from_user_input(crs)
+    key = _file_key(path, crs, kwargs)
+    if key not in _REPROJECTED:
+        _REPROJECTED[key] = to_crs(geopandas.read_file(path, **kwargs), crs)
+    return _REPROJECTED[key]
+
+def preload_reprojected(path:str, crs, loader:Callable[[], geopandas.GeoDataFrame]
+                        )->geopandas.GeoDataFrame:
+    """Fill the cache of `read_reprojected(path, crs)` with loader(), unless
+    it is already there. Used to hand a frame reprojected once to other
+    processes, through a faster format than the source file.
+
+    Parameters
+    ----------
+    path : str
+        Source file, as passed to `read_reprojected`.
+    crs : Any
+        Target CRS, anything accepted by `pyproj.CRS.from_user_input`.
+    loader : Callable
+        Returns the content of path, already in crs.
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+    """
+    key = _file_key(path, CRS.from_user_input(crs), {})
+    if key not in _REPROJECTED:
+        _REPROJECTED[key] = loader()
+    return _REPROJECTED[key]
+
+def clear_cache()->None:
+    """Drop the cached transformers and reprojected frames."""
+    _transformer.cache_clear()
+    _REPROJECTED.clear()
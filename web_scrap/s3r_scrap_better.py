@@ -1,7 +1,17 @@
 import os
 import copy
 import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from geojson_stream import FeatureSink
 
 ###################################
 ####### CHANGE THOSE VARS #########
@@ -61,12 +71,48 @@ PARAMS = {
         'postData': None
 }
 
-def save_json(data:dict, filename:str) -> None:
-    filename = os.path.normpath(filename)
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-    with open(filename, 'w+') as f:
-        json.dump(data, f)
+# maximum number of simultaneous requests to one host
+MAX_CONNECTIONS_PER_HOST = 4
+# CRS of the tables
+S3R_CRS = 'epsg:2950'
+# rows per page, below the limit of 1000 features of the server
+PAGE_SIZE = 999
+
+_HOST_LIMITS: Dict[str, threading.BoundedSemaphore] = {}
+_HOST_LIMITS_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+class LimitedSession(requests.Session):
+    """ Session whose requests are capped per host, across all the threads
+    using a LimitedSession. Connections are kept alive and reused.
+    """
+    def __init__(self, max_connections:int=MAX_CONNECTIONS_PER_HOST):
+        super().__init__()
+        self.max_connections = max_connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        with host_limit(url, self.max_connections):
+            return super().request(method, url, *args, **kwargs)
+
+def host_limit(url:str, max_connections:int=MAX_CONNECTIONS_PER_HOST
+               ) -> threading.BoundedSemaphore:
+    """ Semaphore shared by all the requests to the host of url."""
+    host = urlsplit(url).netloc
+    with _HOST_LIMITS_LOCK:
+        if host not in _HOST_LIMITS:
+            _HOST_LIMITS[host] = threading.BoundedSemaphore(max_connections)
+        return _HOST_LIMITS[host]
+
+def get_session(max_connections:int=MAX_CONNECTIONS_PER_HOST) -> LimitedSession:
+    """ Session of the current thread, created on first use."""
+    if getattr(_LOCAL, 'session', None) is None:
+        _LOCAL.session = LimitedSession(max_connections)
+        _LOCAL.session.headers.update(HEADERS)
+    return _LOCAL.session
 
 def build_query(table: str):
     query = copy.deepcopy(QUERY)
@@ -82,57 +128,208 @@ def build_params(table: str):
 
     return params
 
-def add_limits_params(params, limits, last_id=0):
+def add_limits_params(params, limits, last_id=None, stop_id=None, descending=False):
+    """ Restrict a query to the rows with last_id < ID <= stop_id, sorted by
+    ID, limited to limits rows. Bounds are ignored when None.
+    """
     params = copy.deepcopy(params)
+    conditions = []
+    if last_id is not None:
+        conditions.append('ID > ' + str(last_id))
+    if stop_id is not None:
+        conditions.append('ID <= ' + str(stop_id))
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    order = ' DESC' if descending else ''
     params['postData'] = params['postData'].replace(
             '"}',
-            ' ORDER BY ID LIMIT ' + str(limits) + ' OFFSET ' + str(last_id) + '"}'
-
+            where + ' ORDER BY ID' + order + ' LIMIT ' + str(limits) + '"}'
     )
 
     return params
 
-def query(session: requests.Session, url: str, params: dict):
-    req = session.post(url, params=params)
-
-    if 'message' in req.json() and req.json()['message'] == "Maximum number of features (1000) reached.":
-        i = 0
-        res = {}
-        while True:
-            paramsl = add_limits_params(params, 999, i)
-            req = session.post(url, params=paramsl)
-            i+= 999
-            if req.json()['features']:
-                if not res:
-                    res = req.json()
-                else:
-                    res['features'].append(req.json()['features'])
-            else:
-                return res
-
-    return req.json()
+def post_json(session: requests.Session, url: str, params: dict) -> dict:
+    """ POST a query, raising on HTTP errors."""
+    resp = session.post(url, params=params)
+    resp.raise_for_status()
+
+    return resp.json()
+
+def response_features(data: dict) -> list:
+    """ Features of a query response, raising when the server returned an
+    error instead, so an incomplete table is never saved."""
+    if 'features' not in data:
+        raise ValueError('No features in the response: ' +
+                         str(data.get('message', data))[:200])
+
+    return data['features'] or []
+
+def feature_id(feature: dict):
+    """ ID of a feature, as used by the ORDER BY of the paginated queries."""
+    properties = feature.get('properties') or {}
+    if 'ID' in properties:
+        return properties['ID']
+    if 'id' in feature:
+        return feature['id']
+    raise ValueError('Feature without ID, cannot paginate the query.')
+
+def query_pages(session: requests.Session, url: str, params: dict,
+                last_id=None, stop_id=None, page_size: int = PAGE_SIZE):
+    """ Keyset pagination: each page starts after the last ID of the previous
+    one, so every page costs the same to the server whatever its position.
+
+    Yields
+    ------
+    list
+        The features of each page, in ID order.
+    """
+    while True:
+        paramsl = add_limits_params(params, page_size, last_id, stop_id)
+        features = response_features(post_json(session, url, paramsl))
+        if features:
+            yield features
+        if len(features) < page_size:
+            return
+        last_id = feature_id(features[-1])
+
+def id_bounds(session: requests.Session, url: str, params: dict):
+    """ Lowest and highest ID of a table."""
+    bounds = []
+    for descending in (False, True):
+        paramsl = add_limits_params(params, 1, descending=descending)
+        features = response_features(post_json(session, url, paramsl))
+        bounds.append(feature_id(features[0]) if features else None)
+
+    return tuple(bounds)
+
+def id_ranges(first, last, n_ranges: int):
+    """ Split the IDs first to last in n_ranges (last_id, stop_id] ranges. A
+    single unbounded range is returned for non integer IDs.
+    """
+    if not (isinstance(first, int) and isinstance(last, int)) or n_ranges < 2:
+        return [(None, None)]
+    n_ranges = min(n_ranges, last - first + 1)
+    limits = [first - 1 + (last - first + 1) * k // n_ranges for k in range(n_ranges + 1)]
+    # open ends, in case rows are added while paginating
+    limits[0], limits[-1] = None, None
+
+    return list(zip(limits[:-1], limits[1:]))
+
+def _query_range(url: str, params: dict, last_id, stop_id, page_size: int,
+                 max_connections: int, filename: str) -> int:
+    with FeatureSink(filename, ndjson=True) as sink:
+        for page in query_pages(get_session(max_connections), url, params,
+                                last_id, stop_id, page_size):
+            sink.write(page)
+
+    return sink.n_features
+
+def query(session: requests.Session, url: str, params: dict, sink: FeatureSink,
+          n_ranges: int = 1, page_size: int = PAGE_SIZE) -> int:
+    """ Query a table and write its features to sink, page by page. Above the
+    limit of features of the server, the table is paginated by ID, over
+    n_ranges disjoint ID ranges fetched in parallel. Features are written in
+    ID order.
+
+    Returns
+    -------
+    int
+        Number of features written.
+    """
+    n_features = sink.n_features
+    data = post_json(session, url, params)
+
+    if data.get('message') != "Maximum number of features (1000) reached.":
+        sink.write(response_features(data))
+        return sink.n_features - n_features
+
+    first, last = id_bounds(session, url, params)
+    ranges = id_ranges(first, last, n_ranges)
+    if len(ranges) == 1:
+        for page in query_pages(session, url, params, page_size=page_size):
+            sink.write(page)
+        return sink.n_features - n_features
+
+    # each range is streamed to its own file, then copied in ID order
+    max_connections = getattr(session, 'max_connections', MAX_CONNECTIONS_PER_HOST)
+    filenames = [f'{sink.filename}.{i}.geojsonl' for i in range(len(ranges))]
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(_query_range, url, params, last_id, stop_id,
+                                   page_size, max_connections, filename)
+                       for (last_id, stop_id), filename in zip(ranges, filenames)]
+            for future in futures:
+                future.result()
+        for filename in filenames:
+            sink.append_file(filename)
+    finally:
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    return sink.n_features - n_features
+
+def fetch_table(type_geom:str, arnd:str, table:str,
+                max_connections:int=MAX_CONNECTIONS_PER_HOST,
+                n_ranges:int=1) -> Tuple[str, int]:
+    """ Query one table and stream it to output/{type_geom}/{arnd}.geojson.
+
+    Returns
+    -------
+    filename, n_features
+    """
+    params = build_params(table)
+    filename = f'output/{type_geom}/{arnd}.geojson'
+    with FeatureSink(filename, crs=S3R_CRS) as sink:
+        query(get_session(max_connections), URL, params, sink, n_ranges)
+
+    return sink.filename, sink.n_features
+
+def parse_args():
+    """
+    Argument parser for the script
+
+    Return
+    ------
+    argparse.Namespace
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Download the SRRR tables of every borough.")
+    parser.add_argument("--max-connections", dest='max_connections', type=int,
+                        default=MAX_CONNECTIONS_PER_HOST,
+                        help="Maximum simultaneous requests to the server, default: " +
+                        str(MAX_CONNECTIONS_PER_HOST))
+    parser.add_argument("--ranges", type=int, default=MAX_CONNECTIONS_PER_HOST,
+                        help="ID ranges fetched in parallel for the tables above the "
+                        "feature limit, default: " + str(MAX_CONNECTIONS_PER_HOST))
+    parser.add_argument("--sequential", action="store_true",
+                        help="Query the tables one after the other.")
+
+    return parser.parse_args()
 
 def main():
+    config = parse_args()
 
-    s = requests.Session()
-    s.headers = HEADERS
+    tables = [(type_geom, arnd, query_table)
+              for type_geom, arnd_conf in DATA_TO_FETCH.items()
+              for arnd, query_table in arnd_conf.items()]
 
-    os.makedirs('output', exist_ok=True)
-    for type_geom, arnd_conf in DATA_TO_FETCH.items():
-        print(f'Querying {type_geom}')
-        os.makedirs(f'output/{type_geom}/', exist_ok=True)
-        for arnd, query_table in arnd_conf.items():
+    if config.sequential:
+        for type_geom, arnd, query_table in tables:
             print(f'Querying {type_geom} for district', arnd, end="\r")
-            params = build_params(query_table)
-            data = query(s, URL, params)
-            data['crs'] = {
-                            "type": "name",
-                            "properties": {
-                                "name": "epsg:2950"
-                            }
-                        }
-            save_json(data, f'output/{type_geom}/{arnd}.geojson')
-
+            fetch_table(type_geom, arnd, query_table, config.max_connections, 1)
+        return
+
+    # tables are written as soon as they are complete, the requests of all
+    # the threads share the per host limit
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+        futures = {pool.submit(fetch_table, *table, config.max_connections, config.ranges): table
+                   for table in tables}
+        for future in as_completed(futures):
+            type_geom, arnd, _ = futures[future]
+            filename, n_features = future.result()
+            print(f'{type_geom} for district {arnd}: {n_features} features saved to '
+                  f'{filename} ({time.perf_counter() - start:.1f} s)')
 
 
 if __name__ == '__main__':
@@ -152,4 +349,3 @@ if __name__ == '__main__':
 
 # data = json.loads(response.text)
 
-# save_json(data, 'output/vsmpe_srrr_troncon.geojson')
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+A spatial index keyed on its source file opens without loading the geobase.
+"""
+import os
+import sys
+
+import numpy as np
+import geopandas
+
+WEB_SCRAP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_SCRAP)
+
+from bench_geom import synthetic_network  # noqa: E402
+from geom import MONTREAL_CRS  # noqa: E402
+from index_cache import open_spatial_index, source_key  # noqa: E402
+
+
+def test_source_key_opens_without_loading(tmp_path):
+    roads = str(tmp_path / 'roads.geojson')
+    synthetic_network(200).to_file(roads, driver='GeoJSON')
+    cache_dir = str(tmp_path / 'cache')
+    loads = []
+
+    def load():
+        loads.append(roads)
+        return geopandas.read_file(roads).to_crs(MONTREAL_CRS)
+
+    key = source_key(roads, MONTREAL_CRS)
+    built = open_spatial_index(load, cache_dir, key=key)
+    warm = open_spatial_index(load, cache_dir, key=key)
+
+    assert len(loads) == 1
+    assert warm.store.crs == built.store.crs == load().crs
+    np.testing.assert_array_equal(warm.store.coords, built.store.coords)
+    np.testing.assert_array_equal(warm.store.ids['ID_TRC'], built.store.ids['ID_TRC'])
+
+    # a rewritten source gets a new key
+    os.utime(roads, ns=(0, 0))
+    assert source_key(roads, MONTREAL_CRS) != key
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+The numba and NumPy backends of `kernels` must return identical results.
+
+The numba backend is the `kernels` module itself, the NumPy backend a second
+copy of it imported with GEOM_KERNELS set to 'numpy'.
+"""
+import os
+import sys
+import importlib.util
+
+import numpy as np
+import pytest
+
+WEB_SCRAP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_SCRAP)
+
+import kernels  # noqa: E402
+from bench_geom import synthetic_network, synthetic_points  # noqa: E402
+from grid_index import GridIndex  # noqa: E402
+
+
+def load_numpy_kernels():
+    """Import a copy of kernels with the NumPy backend."""
+    previous = os.environ.get('GEOM_KERNELS')
+    os.environ['GEOM_KERNELS'] = 'numpy'
+    try:
+        spec = importlib.util.spec_from_file_location('kernels_numpy',
+                                                      os.path.join(WEB_SCRAP, 'kernels.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if previous is None:
+            del os.environ['GEOM_KERNELS']
+        else:
+            os.environ['GEOM_KERNELS'] = previous
+    return module
+
+
+@pytest.fixture(scope='module')
+def backends():
+    if kernels.BACKEND != 'numba':
+        pytest.skip('numba is not installed or GEOM_KERNELS forces NumPy')
+    numpy_kernels = load_numpy_kernels()
+    assert numpy_kernels.BACKEND == 'numpy'
+    return kernels, numpy_kernels
+
+def assert_same(results_a, results_b):
+    if not isinstance(results_a, tuple):
+        results_a, results_b = (results_a,), (results_b,)
+    for a, b in zip(results_a, results_b):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+
+def random_xy(rng, n):
+    xy = rng.uniform(0, 100, (n, 2))
+    # degenerate and missing values
+    xy[::17] = np.nan
+    return xy
+
+
+@pytest.mark.parametrize('n', [0, 1, 1000])
+def test_cross_sign(backends, n):
+    rng = np.random.default_rng(n)
+    a_xy, b_xy, p_xy = random_xy(rng, n), random_xy(rng, n), random_xy(rng, n)
+    # points on the line
+    p_xy[::5] = a_xy[::5]
+    assert_same(*(k.cross_sign(a_xy, b_xy, p_xy) for k in backends))
+
+@pytest.mark.parametrize('n', [0, 1, 1000])
+def test_segments_projection(backends, n):
+    rng = np.random.default_rng(n)
+    points_xy, starts_xy, ends_xy = random_xy(rng, n), random_xy(rng, n), random_xy(rng, n)
+    # zero length segments
+    ends_xy[::7] = starts_xy[::7]
+    assert_same(*(k.segments_projection(points_xy, starts_xy, ends_xy) for k in backends))
+
+@pytest.mark.parametrize('counts', [
+    np.array([], dtype=np.int64),
+    np.array([1]),
+    np.array([25]),
+    np.array([1, 3, 8, 2, 1, 40, 5]),
+])
+def test_group_argmin(backends, counts):
+    rng = np.random.default_rng(counts.size)
+    # few distinct values for ties, and NaN
+    values = rng.integers(0, 5, counts.sum()).astype(np.float64)
+    values[rng.random(values.size) < 0.2] = np.nan
+    starts = (np.cumsum(counts) - counts).astype(np.int64)
+    assert_same(*(k.group_argmin(values, starts, counts) for k in backends))
+
+def test_group_argmin_all_nan(backends):
+    values = np.full(4, np.nan)
+    starts, counts = np.array([0]), np.array([4])
+    for k in backends:
+        np.testing.assert_array_equal(k.group_argmin(values, starts, counts), [0])
+
+@pytest.mark.parametrize('n_points', [0, 1, 2000])
+@pytest.mark.parametrize('max_distance', [None, 20.])
+def test_grid_nearest(backends, n_points, max_distance):
+    network = synthetic_network(500)
+    points, _ = synthetic_points(network, max(n_points, 1))
+    points_xy = np.column_stack([points.geometry.x, points.geometry.y])[:n_points]
+    if n_points > 1:
+        points_xy[::13] = np.nan
+        # points outside of the grid
+        points_xy[1::29] += 5000
+
+    grid = GridIndex.from_geodataframe(network, cell_size=40.)
+    max_ring = np.full(len(points_xy), max(grid.nx, grid.ny) + 200, dtype=np.int64)
+    if max_distance is not None:
+        max_ring[:] = int(np.ceil(max_distance / grid.cell_size))
+    max_ring[np.isnan(points_xy).any(axis=1)] = -1
+
+    assert_same(*(k.grid_nearest(points_xy, grid.origin, grid.cell_size, grid.nx, grid.ny,
+                                 grid.cell_offsets, grid.cell_segs, grid.starts_xy,
+                                 grid.ends_xy, grid.seg_row, max_ring)
+                  for k in backends))
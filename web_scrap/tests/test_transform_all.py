@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Consecutive `transform_all` runs must reuse the checkpoints of every borough,
+with spawned workers (the default on Windows) that preload the geobase.
+"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+WEB_SCRAP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_SCRAP)
+
+pytest.importorskip('centerline')
+
+from bench_geom import synthetic_network  # noqa: E402
+
+RUN_SCRIPT = '''
+import sys, multiprocessing
+sys.path.insert(0, {web_scrap!r})
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=True)
+    import transform_all
+    sys.argv = ['transform_all.py', '--input-dir', 'in', '--roads', 'roads.geojson',
+                '--boroughs', 'Verdun', 'Lachine', '--workers', '2',
+                '--checkpoint-dir', 'checkpoints', '--output', 'all.csv']
+    transform_all.main()
+'''
+
+
+def checkpoints(root:str) -> dict:
+    """Modification time of every checkpoint file, by path."""
+    return {os.path.join(d, name): os.path.getmtime(os.path.join(d, name))
+            for d, _, names in os.walk(root) for name in names}
+
+def test_checkpoints_reused_between_runs(tmp_path):
+    network = synthetic_network(300)
+    network.to_file(tmp_path / 'roads.geojson', driver='GeoJSON')
+    os.makedirs(tmp_path / 'in')
+    polygons = network.iloc[:30].copy()
+    polygons['geometry'] = polygons.buffer(2, cap_style='flat')
+    polygons['HEURE'] = '7h00 à 9h00'
+    polygons['LONGUEUR_STAT'] = 10.
+    polygons['NBRE_CASE_STAT'] = 2
+    for borough in ('Verdun', 'Lachine'):
+        polygons[['HEURE', 'LONGUEUR_STAT', 'NBRE_CASE_STAT', 'geometry']].to_file(
+            tmp_path / 'in' / f'{borough}.geojson', driver='GeoJSON')
+
+    script = RUN_SCRIPT.format(web_scrap=WEB_SCRAP)
+    subprocess.run([sys.executable, '-c', script], cwd=tmp_path, check=True,
+                   capture_output=True)
+    first = checkpoints(tmp_path / 'checkpoints')
+    subprocess.run([sys.executable, '-c', script], cwd=tmp_path, check=True,
+                   capture_output=True)
+
+    assert first
+    assert checkpoints(tmp_path / 'checkpoints') == first
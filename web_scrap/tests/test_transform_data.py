@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint keys of `transform_data` must only depend on the code, the stage
+parameters and the input files.
+"""
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+WEB_SCRAP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_SCRAP)
+
+pytest.importorskip('centerline')
+
+import transform_data  # noqa: E402
+from bench_geom import synthetic_network  # noqa: E402
+from geom import MONTREAL_CRS  # noqa: E402
+from projection import clear_cache, read_reprojected  # noqa: E402
+
+KEYS_SCRIPT = '''
+import sys, json
+sys.path.insert(0, {web_scrap!r})
+import transform_data
+print(json.dumps(transform_data.stage_keys({paths!r})))
+'''
+
+
+@pytest.fixture
+def paths(tmp_path):
+    network = synthetic_network(200)
+    roads = str(tmp_path / 'roads.geojson')
+    network.to_file(roads, driver='GeoJSON')
+    df = str(tmp_path / 'df.geojson')
+    network.iloc[:20].buffer(2).to_frame('geometry').to_file(df, driver='GeoJSON')
+    return {'df': df, 'roads': roads, 'delim': None}
+
+def keys_in_new_interpreter(paths:dict, hash_seed:str):
+    script = KEYS_SCRIPT.format(web_scrap=WEB_SCRAP, paths=paths)
+    env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+    out = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def test_stage_keys_same_in_new_interpreters(paths):
+    assert keys_in_new_interpreter(paths, '1') == keys_in_new_interpreter(paths, '2')
+
+def test_stage_keys_ignore_reprojection_cache(paths):
+    clear_cache()
+    before = transform_data.stage_keys(paths)
+    read_reprojected(paths['roads'], MONTREAL_CRS)
+    assert transform_data.stage_keys(paths) == before
+    clear_cache()
+
+def test_stage_source_follows_functions_in_containers():
+    source = transform_data.stage_source(transform_data._stage_road_references)
+    # geodesy.METHODS holds functions, hashed by their source only
+    assert 'def haversine' in source
+    assert ' at 0x' not in source
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+File: transform_all.py
+Description: Run the S3R transformation of `transform_data` on every borough
+scraped by `s3r_scrap_better`, in parallel.
+
+Each borough goes through `transform_data.run_pipeline` in a worker process,
+with its own checkpoints. The geobase is read and reprojected once in the
+main process and saved next to the checkpoints: each worker loads this copy
+once, in its initializer, instead of reading and reprojecting the source
+(forked workers inherit it directly). The regulations of all boroughs are
+merged in a single output.
+
+Usage :
+    python transform_all.py
+    python transform_all.py --workers 3 --delim limits.geojson
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Tuple
+
+import pandas as pd
+
+from geom import MONTREAL_CRS
+from projection import preload_reprojected, read_reprojected
+from s3r_scrap_better import ARRND_TABLE_SRRR_ZONE
+from transform_data import (
+    CHECKPOINT_DIR,
+    CHECKPOINT_EXT,
+    DEFAULT_PATHS,
+    file_hash,
+    load_checkpoint,
+    run_pipeline,
+    save_checkpoint,
+)
+
+INPUT_DIR = os.path.join('output', 'SRRR_Zone')
+DEFAULT_OUTPUT = os.path.join('output', 'srrr_regulation_all.csv')
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Argument parser for the script
+
+    Return
+    ------
+    argparse.Namespace
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(
+            description="Transform the S3R data of every borough into regulations."
+            )
+    parser.add_argument("--input-dir", dest='input_dir', default=INPUT_DIR,
+                        help="Directory of the scraped boroughs, default: " + INPUT_DIR)
+    parser.add_argument("--roads", default=DEFAULT_PATHS['roads'],
+                        help="Geobase file, default: " + DEFAULT_PATHS['roads'])
+    parser.add_argument("--delim", default=None,
+                        help="Boundary applied to every borough, default: none.")
+    parser.add_argument("--boroughs", nargs='+', default=list(ARRND_TABLE_SRRR_ZONE),
+                        help="Boroughs to process, default: all.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes, default: number of CPUs.")
+    parser.add_argument("--checkpoint-dir", dest='checkpoint_dir', default=CHECKPOINT_DIR,
+                        help="Root directory of the checkpoints, default: " + CHECKPOINT_DIR)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="Merged output file, default: " + DEFAULT_OUTPUT)
+
+    return parser.parse_args()
+
+def prepare_geobase(roads:str, checkpoint_dir:str) -> str:
+    """Save the geobase reprojected to MONTREAL_CRS, once per content.
+
+    Returns
+    -------
+    str
+        Path of the reprojected copy.
+    """
+    key = hashlib.sha1(f'{file_hash(roads)}{MONTREAL_CRS}'.encode()).hexdigest()
+    path = os.path.join(checkpoint_dir, f'geobase_{key}{CHECKPOINT_EXT}')
+    geobase = read_reprojected(roads, MONTREAL_CRS)
+    if not os.path.exists(path):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        save_checkpoint(geobase, path)
+    return path
+
+def _init_worker(roads:str, prepared:str) -> None:
+    """Load the reprojected geobase in the reprojection cache of the worker,
+    a no-op when it was inherited from the main process."""
+    preload_reprojected(roads, MONTREAL_CRS, lambda: load_checkpoint(prepared))
+
+def transform_borough(borough:str, paths:dict, checkpoint_dir:str
+                      ) -> Tuple[str, pd.DataFrame, float]:
+    """Run the pipeline on one borough.
+
+    Returns
+    -------
+    borough, regulations, seconds
+    """
+    start = time.perf_counter()
+    # the workers are the parallelism, medial axes are computed in-process
+    df = run_pipeline(paths, os.path.join(checkpoint_dir, borough),
+                      options={'medial_axis': {'n_workers': 1, 'verbose': False}},
+                      verbose=False)
+    df.insert(0, 'arrondissement', borough)
+    return borough, df, time.perf_counter() - start
+
+def main():
+    config = parse_args()
+
+    tasks = {}
+    for borough in config.boroughs:
+        path = os.path.join(config.input_dir, borough + '.geojson')
+        if not os.path.exists(path):
+            print(f'{borough}: no scraped data in {path}, skipped')
+            continue
+        tasks[borough] = {'df': path, 'roads': config.roads, 'delim': config.delim}
+    if not tasks:
+        print('Nothing to transform')
+        sys.exit(1)
+
+    print('Read geobase')
+    prepared = prepare_geobase(config.roads, config.checkpoint_dir)
+
+    start = time.perf_counter()
+    results, failed = {}, []
+    n_workers = min(config.workers or os.cpu_count(), len(tasks))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(config.roads, prepared)) as pool:
+        futures = {pool.submit(transform_borough, borough, paths, config.checkpoint_dir): borough
+                   for borough, paths in tasks.items()}
+        for future in as_completed(futures):
+            borough = futures[future]
+            try:
+                _, df, seconds = future.result()
+            except Exception as error:
+                print(f'{borough}: failed, {error!r}')
+                failed.append(borough)
+                continue
+            results[borough] = df
+            print(f'{borough}: {len(df)} regulations in {seconds:.1f} s')
+
+    print(f'All boroughs done in {time.perf_counter() - start:.1f} s')
+
+    if results:
+        os.makedirs(os.path.dirname(config.output) or '.', exist_ok=True)
+        merged = pd.concat([results[borough] for borough in tasks if borough in results],
+                           ignore_index=True)
+        merged.drop(columns='res_date_debut ').to_csv(config.output, index=False)
+        print(f'Saved {len(merged)} regulations to {config.output}')
+
+    if failed:
+        print('Failed boroughs: ' + ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
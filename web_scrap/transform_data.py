@@ -1,14 +1,36 @@
+import os
+import re
+import time
+import inspect
+import argparse
+import functools
+import hashlib
+import tempfile
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 from operator import itemgetter
-from typing import List
+from typing import Callable, List, Tuple
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from centerline.geometry import Centerline
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from shapely import geometry, ops, GeometryType
 
-from geom import multipointobject_left_or_right
+from geom import MONTREAL_CRS, lines_left_or_right, lines_linear_referencing
+from geojson_stream import read_geojson
+from projection import read_reprojected, to_crs
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    CHECKPOINT_EXT = '.parquet'
+except ImportError:
+    pyarrow = None
+    CHECKPOINT_EXT = '.pkl'
 
 DEFAULT_REG = {
     'deb': 0.0,
@@ -23,8 +45,86 @@ DEFAULT_REG = {
     'longueur_non_marquée': 0.0,
     'nb_places_total': 0
 }
+DEFAULT_PATHS = {
+    'df': 'output/vsmpe_srrr_troncon_POLYGON.geojson',
+    'roads': '../capacity/assets/geobase_simple.geojson',
+    'delim': '../../lapin/data/limites/23505_Parc_Jarry.geojson',
+}
+DEFAULT_OUTPUT = os.path.join('output', 'srrr_regulation_vsmpe.csv')
+CHECKPOINT_DIR = os.path.join('cache', 'stages')
+MEDIAL_AXIS_CACHE_DIR = os.path.join('cache', 'medial_axis')
+# polygons less rectangular than this go through Centerline
+MIN_RECTANGULARITY = 0.9
+# boundary points given to Centerline in adaptive mode
+MAX_BOUNDARY_POINTS = 500
+
+# bit of each day in the res_days bitmask
+DAYS = {'lun': 0, 'mar': 1, 'mer': 2, 'jeu': 3, 'ven': 4, 'sam': 5, 'dim': 6}
+REGULATION_PATTERN = re.compile(
+    r"^(?P<from_h>\d+)h(?P<from_m>\d+) à (?P<to_h>\d+)h(?P<to_m>\d+)"
+    r"(?: du (?P<day_from>\w{3}).+ au (?P<day_to>\w{3}).+)?$"
+)
+
+def adaptive_interpolation_distance(polygon, max_points:int=MAX_BOUNDARY_POINTS):
+    """ Boundary interpolation distance for Centerline, from the size of the
+    polygon: a quarter of its mean width, loosened so that the boundary gets
+    at most max_points points.
 
-def approximate_medial_axis(polygon):
+    Parameters
+    ----------
+    polygon: shapely.geometry.Polygon
+        Polygon on which to compute the medial axis.
+    max_points: int, optional
+        Maximum number of interpolated boundary points. The default is 500.
+
+    Returns
+    -------
+    float
+    """
+    # mean width of a long and thin polygon
+    width = 2 * polygon.area / polygon.length
+    return max(width / 4, polygon.length / max_points)
+
+def longest_path(lines:geometry.MultiLineString)->geometry.LineString:
+    """ Longest path of a skeleton made of 2-points segments, found with two
+    sweeps of Dijkstra: the farthest node from any node is one end of the
+    longest path of a tree.
+
+    Parameters
+    ----------
+    lines: shapely.geometry.MultiLineString
+        The skeleton.
+
+    Returns
+    -------
+    line: shapely.geometry.LineString
+        None for an empty skeleton.
+    """
+    # parts may have more than 2 points, they are split in segments
+    coords, line_ix = shapely.get_coordinates(shapely.get_parts(lines), return_index=True)
+    same_line = line_ix[1:] == line_ix[:-1]
+    if not same_line.any():
+        return None
+    nodes, node_ix = np.unique(coords, axis=0, return_inverse=True)
+    node_ix = node_ix.ravel()
+    start, end = node_ix[:-1][same_line], node_ix[1:][same_line]
+    length = np.hypot(*(coords[1:][same_line] - coords[:-1][same_line]).T)
+
+    graph = csr_matrix((length, (start, end)), shape=(len(nodes), len(nodes)))
+    dist = dijkstra(graph, directed=False, indices=start[0])
+    source = np.argmax(np.where(np.isinf(dist), -1, dist))
+    dist, predecessors = dijkstra(graph, directed=False, indices=source,
+                                  return_predecessors=True)
+    node = np.argmax(np.where(np.isinf(dist), -1, dist))
+
+    path = [node]
+    while predecessors[node] >= 0:
+        node = predecessors[node]
+        path.append(node)
+    return geometry.LineString(nodes[path[::-1]])
+
+def approximate_medial_axis(polygon, interpolation_distance:float=0.5,
+                            adaptive:bool=False, simplify_tolerance:float=0.):
     """ This is an approximation for buffered linestrign like polygon.
     It only keep the longuest segment of the polygon skeleton.
 
@@ -32,13 +132,29 @@ def approximate_medial_axis(polygon):
     ----------
     polygon: shapely.geometry.Polygon
         Polygon on which to compute the medial axis.
+    interpolation_distance: float, optional
+        Distance between the boundary points given to Centerline. The default
+        is 0.5.
+    adaptive: bool, optional
+        If True, the polygon is simplified, the interpolation distance is
+        chosen with `adaptive_interpolation_distance` and the longest path of
+        the skeleton is returned instead of its longest merged part. The
+        default is False.
+    simplify_tolerance: float, optional
+        Tolerance of the simplification of the polygon in adaptive mode, in
+        the units of the CRS. The default is 0, no simplification.
 
     Returns
     -------
     line: shapely.geometry.LineString
     """
+    if adaptive:
+        if simplify_tolerance > 0:
+            polygon = polygon.simplify(simplify_tolerance, preserve_topology=True)
+        interpolation_distance = adaptive_interpolation_distance(polygon)
+        return longest_path(Centerline(polygon, interpolation_distance).geometry)
 
-    skeleton = Centerline(polygon).geometry
+    skeleton = Centerline(polygon, interpolation_distance).geometry
 
     skeleton = ops.linemerge(skeleton)
 
@@ -46,6 +162,62 @@ def approximate_medial_axis(polygon):
 
     return skeleton.geoms[np.argmax(skeleton_part_size)]
 
+def rectangularity(polygons:gpd.GeoSeries)->np.ndarray:
+    """ Ratio between the area of each polygon and the area of its minimum
+    rotated rectangle envelope: 1 for a rectangle, lower for irregular shapes.
+
+    Parameters
+    ----------
+    polygons: gpd.GeoSeries
+        Polygons to score.
+
+    Returns
+    -------
+    score: np.ndarray[float]
+        0 for empty, missing or flat polygons.
+    """
+    geoms = np.asarray(polygons, dtype=object)
+    envelope_area = shapely.area(shapely.oriented_envelope(geoms))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = shapely.area(geoms) / envelope_area
+    return np.nan_to_num(score, nan=0., posinf=0.)
+
+def rectangle_medial_axes(polygons:gpd.GeoSeries)->np.ndarray:
+    """ Medial axis of the minimum rotated rectangle envelope of every
+    polygon: the line joining the middles of its two short sides.
+
+    Parameters
+    ----------
+    polygons: gpd.GeoSeries
+        Polygons on which to compute the medial axis.
+
+    Returns
+    -------
+    lines: np.ndarray[shapely.geometry.LineString]
+        None for empty, missing or flat polygons.
+    """
+    geoms = np.asarray(polygons, dtype=object)
+    envelopes = shapely.oriented_envelope(geoms)
+    lines = np.full(geoms.size, None, dtype=object)
+
+    valid = np.flatnonzero(shapely.get_type_id(envelopes) == GeometryType.POLYGON)
+    valid = valid[shapely.area(envelopes[valid]) > 0]
+    if valid.size == 0:
+        return lines
+
+    corners = shapely.get_coordinates(shapely.get_exterior_ring(envelopes[valid]))
+    corners = corners.reshape(-1, 5, 2)[:, :4]
+    side_1 = np.hypot(*(corners[:, 1] - corners[:, 0]).T)
+    side_2 = np.hypot(*(corners[:, 2] - corners[:, 1]).T)
+
+    # when the first side is the long one, the short ones are (1, 2) and (3, 0)
+    long_first = (side_1 >= side_2)[:, None]
+    start = np.where(long_first, corners[:, 3] + corners[:, 0], corners[:, 0] + corners[:, 1]) / 2
+    end = np.where(long_first, corners[:, 1] + corners[:, 2], corners[:, 2] + corners[:, 3]) / 2
+
+    lines[valid] = shapely.linestrings(np.stack([start, end], axis=1))
+    return lines
+
 def approximate_medial_axis_rect(rectangle):
     """ This is an approximation for a rectangle.
     It retrun the medial axis of the rotated rectangle
@@ -60,44 +232,237 @@ def approximate_medial_axis_rect(rectangle):
     -------
     line: shapely.geometry.LineString
     """
-    if isinstance(rectangle, MultiPolygon):
+    if isinstance(rectangle, geometry.MultiPolygon):
         if len(list(rectangle.geoms))>1:
-            raise(NotImplementedError, "Multipolygones are not implementend.")
+            raise NotImplementedError("Multipolygones are not implementend.")
         rectangle = rectangle.geoms[0]
 
-    medial_axis_candidates = list(rectangle.minimum_rotated_rectangle.exterior.coords)
+    return rectangle_medial_axes([rectangle])[0]
+
+def _medial_axis_key(wkb:bytes, method:Callable, kwargs:dict)->str:
+    """Cache key of the medial axis of one polygon."""
+    sha = hashlib.sha1(wkb)
+    sha.update(f'{method.__name__}{sorted(kwargs.items())}'.encode())
+    return sha.hexdigest()
+
+def _medial_axis_task(task:Tuple[bytes, Callable, dict])->Tuple[bytes, float]:
+    """Compute the medial axis of one WKB polygon.
+
+    Returns
+    -------
+    wkb, seconds
+        The medial axis as WKB, an empty line when there is none, and the
+        time it took.
+    """
+    wkb, method, kwargs = task
+    start = time.perf_counter()
+    axis = method(shapely.from_wkb(wkb), **kwargs)
+    # no axis is cached as an empty line
+    if axis is None:
+        axis = geometry.LineString()
+    return shapely.to_wkb(axis), time.perf_counter() - start
+
+def _axis_from_wkb(wkb:bytes)->shapely.Geometry:
+    """Medial axis of a WKB from the cache, None for an empty line."""
+    axis = shapely.from_wkb(wkb)
+    return None if axis.is_empty else axis
+
+class _SerialExecutor():
+    """Executor running the tasks in the current process."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def map(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+def compute_medial_axis(polygons:gpd.GeoSeries,
+                        method:Callable=approximate_medial_axis,
+                        n_workers:int=None,
+                        cache_dir:str=MEDIAL_AXIS_CACHE_DIR,
+                        verbose:bool=True,
+                        **kwargs)->Tuple[gpd.GeoSeries, pd.Series]:
+    """ Compute the medial axis of every polygon with a pool of processes.
+
+    Results are cached on disk, one file per polygon, named after the hash of
+    the polygon WKB and of the method. Re-running on a dataset where only a
+    few polygons changed only recomputes those.
+
+    Parameters
+    ----------
+    polygons: gpd.GeoSeries
+        Polygons on which to compute the medial axis.
+    method: Callable, optional
+        Medial axis function of one polygon. The default is
+        approximate_medial_axis.
+    n_workers: int, optional
+        Number of worker processes, 1 to compute in this process. The default
+        is None, meaning the number of CPUs.
+    cache_dir: str, optional
+        Directory of the cache, None to disable it. The default is
+        'cache/medial_axis'.
+    verbose: bool, optional
+        Print the progress and the slowest polygons. The default is True.
+    **kwargs
+        Passed to method.
+
+    Returns
+    -------
+    gpd.GeoSeries
+        The medial axes, with the index of polygons. Missing polygons and
+        polygons without an axis give missing axes.
+    pd.Series
+        Computation time of each polygon in seconds, NaN when it was read
+        from the cache.
+    """
+    geoms = np.asarray(polygons.values, dtype=object)
+    axes = np.full(geoms.size, None, dtype=object)
+    timings = np.full(geoms.size, np.nan)
+
+    todo = np.flatnonzero(~shapely.is_missing(geoms))
+    wkbs = shapely.to_wkb(geoms[todo])
+    keys = [_medial_axis_key(wkb, method, kwargs) for wkb in wkbs]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cached = np.array([os.path.exists(os.path.join(cache_dir, key + '.wkb'))
+                           for key in keys], dtype=bool)
+        for i in np.flatnonzero(cached):
+            with open(os.path.join(cache_dir, keys[i] + '.wkb'), 'rb') as f:
+                axes[todo[i]] = _axis_from_wkb(f.read())
+    else:
+        cached = np.zeros(todo.size, dtype=bool)
+
+    missing = np.flatnonzero(~cached)
+    if verbose:
+        print(f'  {cached.sum()} medial axes read from cache, {missing.size} to compute')
+
+    tasks = [(wkbs[i], method, kwargs) for i in missing]
+    n_workers = n_workers or os.cpu_count()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else \
+            _SerialExecutor() as pool:
+        results = pool.map(_medial_axis_task, tasks,
+                           chunksize=max(1, len(tasks) // (n_workers * 16)))
+        for done, (i, (wkb, seconds)) in enumerate(zip(missing, results), start=1):
+            axes[todo[i]] = _axis_from_wkb(wkb)
+            timings[todo[i]] = seconds
+            if cache_dir is not None:
+                fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix='.wkb.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(wkb)
+                os.replace(tmp_name, os.path.join(cache_dir, keys[i] + '.wkb'))
+            if verbose and (done % max(1, len(tasks) // 20) == 0 or done == len(tasks)):
+                print(f'  {done}/{len(tasks)} medial axes computed '
+                      f'({time.perf_counter() - start:.1f} s)', flush=True)
+
+    timings = pd.Series(timings, index=polygons.index, name='medial_axis_seconds')
+    if verbose and missing.size:
+        print('  Slowest polygons (index, seconds):')
+        for index, seconds in timings.nlargest(5).items():
+            print(f'    {index}: {seconds:.2f}')
+
+    return gpd.GeoSeries(axes, index=polygons.index, crs=polygons.crs), timings
+
+def medial_axes(polygons:gpd.GeoSeries,
+                min_rectangularity:float=MIN_RECTANGULARITY,
+                verbose:bool=True,
+                **kwargs)->gpd.GeoSeries:
+    """ Medial axis of every polygon, choosing the method by shape: the
+    rotated rectangle axis for near rectangular polygons, Centerline for the
+    others.
+
+    Parameters
+    ----------
+    polygons: gpd.GeoSeries
+        Polygons on which to compute the medial axis.
+    min_rectangularity: float, optional
+        Polygons with a rectangularity (see `rectangularity`) of at least this
+        value use `rectangle_medial_axes`. The default is 0.9.
+    verbose: bool, optional
+        Print the number of polygons sent to each method. The default is True.
+    **kwargs
+        Passed to compute_medial_axis.
 
+    Returns
+    -------
+    gpd.GeoSeries
+        The medial axes, with the index of polygons.
+    """
+    axes = gpd.GeoSeries(rectangle_medial_axes(polygons), index=polygons.index,
+                         crs=polygons.crs)
+    irregular = (rectangularity(polygons) < min_rectangularity) & \
+                ~shapely.is_missing(np.asarray(polygons, dtype=object))
+    if verbose:
+        print(f'  {(~irregular).sum()} rectangular polygons, {irregular.sum()} '
+              'sent to Centerline')
+    if irregular.any():
+        axes[irregular], _ = compute_medial_axis(polygons[irregular], verbose=verbose,
+                                                 **kwargs)
+    return axes
+
+@functools.lru_cache(maxsize=None)
+def _parse_regulation(text:str)->Tuple[int, int, int]:
+    """ Parse one regulation string.
 
-    return LineString([medial_axis[0], medial_axis[3]])
+    Returns
+    -------
+    hour_from, hour_to, days
+        Minutes since midnight and day-of-week bitmask, -1 when missing.
+    """
+    match = REGULATION_PATTERN.match(text)
+    if match is None:
+        return -1, -1, -1
+    hour_from = int(match['from_h']) * 60 + int(match['from_m'])
+    hour_to = int(match['to_h']) * 60 + int(match['to_m'])
+    if match['day_from'] is None:
+        return hour_from, hour_to, -1
+
+    day_from = DAYS.get(match['day_from'].lower())
+    day_to = DAYS.get(match['day_to'].lower())
+    if day_from is None or day_to is None:
+        return hour_from, hour_to, -1
+    # spans can wrap around the week, e.g. sam. au lun.
+    days = sum(1 << ((day_from + i) % 7) for i in range((day_to - day_from) % 7 + 1))
+    return hour_from, hour_to, days
 
 def parse_regulation_string(df:pd.Series):
     """ Take a regulation serie string at s3r format and parse information about
     hour start, hour end, days and active period.
-    """
-
-    hour_and_days_reg = df.str.extractall(
-            r"^(?P<res_hour_from>\d+h\d+) à "+
-            "(?P<res_hour_to>\d+h\d+) du "+
-            "(?P<res_day_from>\w{3}).+ au (?P<res_day_to>\w{3}).+$"
-    )
-    hour_only_reg = df.str.extractall(
-            r"^(?P<res_hour_from>\d+h\d+) à "+
-            "(?P<res_hour_to>\d+h\d+)$"
-    )
 
-    # assert that index are not overlapping
-    assert np.intersect1d(
-        hour_and_days_reg.reset_index(level=1).index,
-        hour_only_reg.reset_index(level=1).index
-    ).shape[0] == 0
+    Each distinct string is parsed once, with a single pattern, and the
+    results are broadcasted back to the rows.
 
-    # format days span
-    hour_and_days_reg['res_days'] = hour_and_days_reg['res_day_from'] + '-' + \
-                                    hour_and_days_reg['res_day_to']
+    Parameters
+    ----------
+    df: pd.Series
+        Regulation strings, like '9h00 à 17h00 du lun. au ven.' or
+        '9h00 à 17h00'.
 
-    # concat both dataset
-    regs = pd.concat([hour_and_days_reg, hour_only_reg]).reset_index(level=1,
-                                                                     drop=True)
+    Returns
+    -------
+    pd.DataFrame
+        Indexed like df, with columns:
+            res_hour_from, res_hour_to: Int16, minutes since midnight
+            res_days: UInt8, bit i is set when day i is active, Monday being
+                day 0 (see DAYS). Missing when no days are given.
+        Rows that do not match the format are missing.
+    """
+    codes, uniques = pd.factorize(df)
+    parsed = np.array([_parse_regulation(text) if isinstance(text, str) else (-1, -1, -1)
+                       for text in uniques], dtype=np.int16).reshape(-1, 3)
+    # code -1 (missing string) picks the extra missing row
+    parsed = np.vstack([parsed, np.full((1, 3), -1, dtype=np.int16)])[codes]
+
+    regs = pd.DataFrame({
+        'res_hour_from': pd.array(parsed[:, 0], dtype='Int16'),
+        'res_hour_to': pd.array(parsed[:, 1], dtype='Int16'),
+        'res_days': pd.array(parsed[:, 2], dtype='Int16'),
+    }, index=df.index)
+    regs = regs.mask(regs == -1)
+    regs['res_days'] = regs['res_days'].astype('UInt8')
 
     return regs
 
@@ -116,16 +481,9 @@ def linear_referencing_linestring(line1: geometry.LineString, line2: geometry.Li
     shapely.Point
         Second point postion on line2
     """
-    pt1 = geometry.Point(line1.coords[0])
-    pt2 = geometry.Point(line1.coords[-1])
+    deb, fin = lines_linear_referencing(line1, line2)
 
-    pt1_proj = line2.project(pt1)
-    pt2_proj = line2.project(pt2)
-
-    if pt1_proj > pt2_proj:
-        return pt2_proj, pt1_proj
-
-    return pt1_proj, pt2_proj
+    return float(deb), float(fin)
 
 def compute_linear_ref_on_roads(df:gpd.GeoDataFrame,
                                 roads:gpd.GeoDataFrame, join_on='ID_TRC'):
@@ -136,10 +494,8 @@ def compute_linear_ref_on_roads(df:gpd.GeoDataFrame,
 
     df = df.join(roads.set_index(join_on)[['road_geom']], on=join_on)
 
-    df['deb'], df['fin'] = zip(*df.apply(
-        lambda x: linear_referencing_linestring(x.geometry, x.road_geom),
-        axis=1
-    ))
+    df['deb'], df['fin'] = lines_linear_referencing(df.geometry.values,
+                                                    df['road_geom'].values)
 
     df = df.drop(columns='road_geom')
 
@@ -150,6 +506,10 @@ def compute_left_or_right_linestring(df:gpd.GeoDataFrame,
                                      roads:gpd.GeoDataFrame, join_on='ID_TRC'):
     """ Compute on which side of the road each element of s3r_df lands.
 
+    The computation is done in the CRS of df: with the euclidean distance
+    when it is projected (MONTREAL_CRS), with the geodesic distance when it is
+    geographic. roads are reprojected to it only if needed.
+
     Parameters
     ----------
     df: geopandas.GeoDataFrame
@@ -162,27 +522,72 @@ def compute_left_or_right_linestring(df:gpd.GeoDataFrame,
         df enhanced with side_of_street column.
     """
 
-    df_crs = df.crs
-
     df = df.copy()
-    roads = roads.copy()
-
-    df = df.to_crs('epsg:4326')
-    roads = roads.to_crs('epsg:4326')
-    roads = roads.rename_geometry('road_geom')
+    roads = to_crs(roads, df.crs).rename_geometry('road_geom')
 
     df = df.join(roads.set_index(join_on)[['road_geom']], on=join_on)
 
-    df['side_of_street'] = df.apply(
-            lambda x: multipointobject_left_or_right(x.road_geom,
-                                                     geometry.Point(x.geometry.coords[0])),
-            axis=1)
+    df['side_of_street'] = lines_left_or_right(
+            df['road_geom'].values,
+            shapely.get_point(df.geometry.values, 0),
+            great_circle=not df.crs.is_projected
+    )
 
-    df = df.to_crs(df_crs)
     df = df.drop(columns='road_geom')
 
     return df
 
+def compute_road_references(df:gpd.GeoDataFrame,
+                            roads:gpd.GeoDataFrame, join_on='ID_TRC'):
+    """ Compute the side of the road and the linear referencing of each
+    element of df in one pass. Each geometry is aligned with its road once,
+    by position, and the side_of_street, deb and fin columns are added to a
+    shallow copy of df: the data of df and roads is not copied.
+
+    Parameters
+    ----------
+    df: geopandas.GeoDataFrame
+        Lines matched to a road through the join_on column.
+    roads: geopandas.GeoDataFrame
+        Roads, with unique join_on values (multi-part roads must not be
+        exploded). Reprojected to the CRS of df if needed.
+    join_on: str, optional
+        Road identifier column. The default is 'ID_TRC'.
+
+    Raises
+    ------
+    ValueError
+        Several roads share a join_on value.
+
+    Return
+    ------
+    gpd.GeoDataFrame
+        df enhanced with side_of_street, deb and fin columns. Elements
+        without a road get a side of 0 and NaN positions.
+    """
+    road_ids = pd.Index(roads[join_on])
+    if not road_ids.is_unique:
+        duplicated = road_ids[road_ids.duplicated()].unique()
+        raise ValueError(f'{duplicated.size} {join_on} values are shared by several roads, '
+                         f'ie {list(duplicated[:5])}. Dissolve the parts of each road '
+                         'before computing the road references.')
+
+    df = df.copy(deep=False)
+    roads = to_crs(roads, df.crs)
+    road_ix = road_ids.get_indexer(df[join_on])
+    road_geoms = np.asarray(roads.geometry.values, dtype=object)[road_ix]
+    road_geoms[road_ix < 0] = None
+
+    lines = np.asarray(df.geometry.values, dtype=object)
+    df['side_of_street'] = lines_left_or_right(
+            road_geoms,
+            shapely.get_point(lines, 0),
+            great_circle=not df.crs.is_projected
+    )
+    df['deb'], df['fin'] = lines_linear_referencing(lines, road_geoms)
+
+    return df
+
 def find_nearest_road(df:gpd.GeoDataFrame, roads:gpd.GeoDataFrame, **kwargs):
     """ For each geometry in df, find the closest road associated with it.
     """
@@ -207,63 +612,286 @@ def finalize(df:gpd.GeoDataFrame):
 
     return df[['segment'] + list(DEFAULT_REG.keys()) + ['side_of_street']]
 
-def main():
-
-    # read data
-    print('Read data')
-    df = gpd.read_file('output/vsmpe_srrr_troncon_POLYGON.geojson')
-    roads = gpd.read_file('../capacity/assets/geobase_simple.geojson')
-    delim = gpd.read_file('../../lapin/data/limites/23505_Parc_Jarry.geojson')
+def _stage_read(df, paths:dict):
+    return to_crs(read_geojson(paths['df']), MONTREAL_CRS)
 
-    # transform crs to Montreal
-    df = df.to_crs('epsg:32188')
-    roads = roads.to_crs('epsg:32188')
-    delim = delim.to_crs('epsg:32188')
-
-    # get the medial axis
-    print('Medial axis computation')
-    df.geometry = df.geometry.apply(approximate_medial_axis)
+def _stage_medial_axis(df, paths:dict, n_workers:int=None, verbose:bool=True):
+    df.geometry = medial_axes(df.geometry, n_workers=n_workers, verbose=verbose)
+    return df
 
-    # process SRRR reglementation
-    print('SRRR regulation parsing')
-    df = df.join(parse_regulation_string(df.HEURE), how='left')
+def _stage_regulation(df, paths:dict):
+    return df.join(parse_regulation_string(df.HEURE), how='left')
 
-    # find clothest roads
-    print('Clothest roads join')
-    df = find_nearest_road(
+def _stage_nearest_road(df, paths:dict, max_distance:float):
+    roads = read_reprojected(paths['roads'], MONTREAL_CRS)
+    # if two or more roads are at equal distance of a segment,
+    # only keep the first one.
+    # df = df.groupby(level=0).nth(0)
+    return find_nearest_road(
             df,
             roads[['ID_TRC', 'geometry']],
             how='left',
             exclusive=True,
-            max_distance=10,
+            max_distance=max_distance,
     )
-    # if two or more roads are at equal distance of a segment,
-    # only keep the first one.
-    # df = df.groupby(level=0).nth(0)
 
-    # compute side_of_street
-    print('Side of street computation')
-    df = compute_left_or_right_linestring(df, roads, join_on='ID_TRC')
-
-    # compute linear referencing
-    print('Linear referencing computation')
-    df = compute_linear_ref_on_roads(df, roads, join_on='ID_TRC')
+def _stage_road_references(df, paths:dict):
+    roads = read_reprojected(paths['roads'], MONTREAL_CRS)
+    return compute_road_references(df, roads, join_on='ID_TRC')
 
+def _stage_clip(df, paths:dict):
     # cut roads that are outside delim
-    df = gpd.sjoin(
+    if paths.get('delim') is None:
+        return df
+    delim = to_crs(gpd.read_file(paths['delim']), MONTREAL_CRS)
+    return gpd.sjoin(
             left_df=df.drop(columns=['index_right', 'index_left'], errors='ignore'),
             right_df=delim,
             how='inner',
             predicate='within'
     )
 
-    # make it into regulation
-    print('Final touch')
-    df = finalize(df)
+def _stage_finalize(df, paths:dict):
+    return finalize(df)
+
+# name, function, input files and parameters of each stage, in order
+STAGES = [
+    ('read', _stage_read, ('df',), {}),
+    ('medial_axis', _stage_medial_axis, (), {}),
+    ('regulation', _stage_regulation, (), {}),
+    ('nearest_road', _stage_nearest_road, ('roads',), {'max_distance': 10}),
+    ('road_references', _stage_road_references, ('roads',), {}),
+    ('clip', _stage_clip, ('delim',), {}),
+    ('finalize', _stage_finalize, (), {}),
+]
+
+def file_hash(path:str)->str:
+    """ sha1 of the content of a file."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _is_local(obj)->bool:
+    """ Whether obj is defined in a module of this directory."""
+    try:
+        path = inspect.getsourcefile(obj)
+    except TypeError:
+        return False
+    return path is not None and \
+        os.path.dirname(os.path.abspath(path)) == os.path.dirname(os.path.abspath(__file__))
+
+def _constant_repr(value)->str:
+    """ Deterministic text of a constant: numbers, strings, compiled patterns
+    and containers of those. None for anything else."""
+    if value is None or isinstance(value, (str, bytes, bool, int, float)):
+        return repr(value)
+    if isinstance(value, re.Pattern):
+        return f're.compile({value.pattern!r}, {value.flags})'
+    if isinstance(value, (tuple, list)):
+        items = [_constant_repr(item) for item in value]
+        if None not in items:
+            return f'{type(value).__name__}({", ".join(items)})'
+    elif isinstance(value, (set, frozenset)):
+        items = [_constant_repr(item) for item in value]
+        if None not in items:
+            return f'{type(value).__name__}({", ".join(sorted(items))})'
+    elif isinstance(value, dict):
+        items = [(_constant_repr(k), _constant_repr(v)) for k, v in value.items()]
+        if all(k is not None and v is not None for k, v in items):
+            return '{' + ', '.join(f'{k}: {v}' for k, v in items) + '}'
+    return None
+
+def stage_source(func:Callable)->str:
+    """ Source of a stage and of every function, class, module and constant
+    of this directory it uses, directly or not, so that editing a helper
+    changes the key of the stages relying on it.
+
+    Constants are hashed by value. Functions found in containers (like
+    geodesy.METHODS) are hashed by their source. Private module globals
+    (caches like projection._REPROJECTED) and other runtime objects are
+    ignored, so keys only depend on the code.
+    """
+    sources = {}
+    todo = [func]
+    while todo:
+        obj = inspect.unwrap(todo.pop())
+        if not _is_local(obj):
+            continue
+        name = getattr(obj, '__qualname__', getattr(obj, '__name__', ''))
+        key = f'{getattr(obj, "__module__", "")}.{name}'
+        if key in sources:
+            continue
+        sources[key] = inspect.getsource(obj)
+        if not inspect.isfunction(obj):
+            # modules and classes are hashed as a whole
+            continue
+        # names used by the function and the lambdas, comprehensions... in it
+        codes, names = [obj.__code__], set()
+        while codes:
+            code = codes.pop()
+            names.update(code.co_names)
+            codes.extend(c for c in code.co_consts if inspect.iscode(c))
+        for n in names:
+            if n not in obj.__globals__:
+                continue
+            value = obj.__globals__[n]
+            if callable(value) or inspect.ismodule(value):
+                todo.append(value)
+            elif n.startswith('_'):
+                # private state, like caches
+                continue
+            elif _constant_repr(value) is not None:
+                # module constants, such as DEFAULT_REG
+                sources[f'{obj.__module__}.{n}'] = _constant_repr(value)
+            elif isinstance(value, dict):
+                todo.extend(value.values())
+            elif isinstance(value, (tuple, list, set, frozenset)):
+                todo.extend(value)
+        todo.extend(obj.__defaults__ or ())
+        todo.extend((obj.__kwdefaults__ or {}).values())
+    return ''.join(sources[key] for key in sorted(sources))
+
+def stage_keys(paths:dict)->List[str]:
+    """ Key of the checkpoint of each stage: a hash of the key of the
+    previous stage, of the stage code and parameters and of its input files.
+    The stage code includes the helpers of this directory it calls (see
+    `stage_source`). A change only invalidates the stage where it enters and
+    the following ones. Upgrades of the installed libraries are not detected:
+    rerun with --from-stage after one.
+    """
+    keys = []
+    key = ''
+    for name, func, inputs, params in STAGES:
+        sha = hashlib.sha1(key.encode())
+        sha.update(f'{name}{sorted(params.items())}'.encode())
+        sha.update(stage_source(func).encode())
+        for input_name in inputs:
+            if paths.get(input_name) is not None:
+                sha.update(file_hash(paths[input_name]).encode())
+        key = sha.hexdigest()
+        keys.append(key)
+    return keys
+
+def _checkpoint_path(checkpoint_dir:str, name:str, key:str)->str:
+    return os.path.join(checkpoint_dir, f'{name}_{key}{CHECKPOINT_EXT}')
+
+def save_checkpoint(df:pd.DataFrame, path:str):
+    """ Atomically write a stage output, as GeoParquet when pyarrow is
+    installed, as a pickle otherwise."""
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    if pyarrow is not None:
+        df.to_parquet(tmp_name)
+    else:
+        df.to_pickle(tmp_name)
+    os.replace(tmp_name, path)
+
+def load_checkpoint(path:str)->pd.DataFrame:
+    """ Read a stage output written by save_checkpoint."""
+    if pyarrow is None:
+        return pd.read_pickle(path)
+    if b'geo' in (pyarrow.parquet.read_schema(path).metadata or {}):
+        return gpd.read_parquet(path)
+    return pd.read_parquet(path)
+
+def run_pipeline(paths:dict, checkpoint_dir:str=CHECKPOINT_DIR,
+                 from_stage:str=None, options:dict=None,
+                 verbose:bool=True)->pd.DataFrame:
+    """ Run the stages of the transformation, skipping the ones whose
+    checkpoint is up to date.
+
+    Parameters
+    ----------
+    paths: dict
+        Input files: 'df' (S3R polygons), 'roads' (geobase) and 'delim'
+        (boundary, None to keep everything).
+    checkpoint_dir: str, optional
+        Directory of the checkpoints. The default is 'cache/stages'.
+    from_stage: str, optional
+        Recompute this stage and the following ones, even if their checkpoint
+        exists. The checkpoint of the previous stage must exist. The default
+        is None, meaning from the first stage without an up to date
+        checkpoint.
+    options: dict, optional
+        Extra keyword arguments of some stages, by stage name, that do not
+        change their output (like {'medial_axis': {'n_workers': 1}}). They are
+        not part of the checkpoint keys. The default is None.
+    verbose: bool, optional
+        Print the stages and their timings. The default is True.
+
+    Raises
+    ------
+    ValueError
+        Unknown stage, or no checkpoint to resume from.
+
+    Returns
+    -------
+    pd.DataFrame
+        Output of the last stage.
+    """
+    names = [stage[0] for stage in STAGES]
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoints = [_checkpoint_path(checkpoint_dir, name, key)
+                   for name, key in zip(names, stage_keys(paths))]
+
+    if from_stage is None:
+        done = [i for i, path in enumerate(checkpoints) if os.path.exists(path)]
+        start = done[-1] + 1 if done else 0
+    else:
+        if from_stage not in names:
+            raise ValueError(f'Unknown stage {from_stage}, expecting one of {names}')
+        start = names.index(from_stage)
+        if start > 0 and not os.path.exists(checkpoints[start - 1]):
+            raise ValueError(f'No up to date checkpoint for stage {names[start - 1]}, '
+                             f'cannot resume from {from_stage}')
+
+    for name in names[:start]:
+        if verbose:
+            print(f'Stage {name}: up to date')
+    df = load_checkpoint(checkpoints[start - 1]) if start > 0 else None
+
+    for i in range(start, len(STAGES)):
+        name, func, _, params = STAGES[i]
+        if verbose:
+            print(f'Stage {name}')
+        stage_start = time.perf_counter()
+        df = func(df, paths, **params, **(options or {}).get(name, {}))
+        save_checkpoint(df, checkpoints[i])
+        if verbose:
+            print(f'  done in {time.perf_counter() - stage_start:.1f} s')
+
+    return df
+
+def parse_args():
+    """
+    Argument parser for the script
+
+    Return
+    ------
+    argparse.Namespace
+        Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Transform the S3R VSMPE data into regulations.")
+    parser.add_argument("--from-stage", dest='from_stage', default=None,
+                        choices=[stage[0] for stage in STAGES],
+                        help="Recompute from this stage, even if it is up to date.")
+    parser.add_argument("--checkpoint-dir", dest='checkpoint_dir', default=CHECKPOINT_DIR,
+                        help="Directory of the stage checkpoints, default: " + CHECKPOINT_DIR)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="Output file, default: " + DEFAULT_OUTPUT)
+
+    return parser.parse_args()
+
+def main():
+    config = parse_args()
+
+    df = run_pipeline(DEFAULT_PATHS, config.checkpoint_dir, config.from_stage)
 
     # save
     print('Save')
-    df.drop(columns='res_date_debut ').to_csv('./output/srrr_regulation_vsmpe.csv', index=False)
+    df.drop(columns='res_date_debut ').to_csv(config.output, index=False)
 
 if __name__ == '__main__':
     main()
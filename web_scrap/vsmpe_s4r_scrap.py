@@ -1,21 +1,23 @@
-import os
 import sys
 import requests
 import json
 from typing import Tuple
 
-URL = "https://spectrum.montreal.ca/connect/analyst/controller/connectProxy/rest/Spatial/FeatureService?url=/tables/19_VSMPE/Transport/VSMPE_TRA_SRRR_TRONCON/features.json/{}"
+from geojson_stream import FeatureSink
 
-def save_json(data:dict, filename:str) -> None:
-    filename = os.path.normpath(filename)
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+OUTPUT = './output/s3r_vsmpe.geojson'
+CRS = 'epsg:42104'
 
-    with open(filename, 'w+') as f:
-        json.dump(data, f)
+URL = "https://spectrum.montreal.ca/connect/analyst/controller/connectProxy/rest/Spatial/FeatureService?url=/tables/19_VSMPE/Transport/VSMPE_TRA_SRRR_TRONCON/features.json/{}"
 
-def iterate(index) -> Tuple[dict, int]:
+def iterate(index, sink:FeatureSink) -> Tuple[int, int]:
+    """ Write the pages from index to the first empty one in sink.
 
-    data = []
+    Returns
+    -------
+    n_features, index of the empty page
+    """
+    n_features = 0
     while(True):
         print('Current data index: ' + str(index), end='\r')
 
@@ -34,33 +36,26 @@ def iterate(index) -> Tuple[dict, int]:
             # we are at the end of the database
             break
 
-        data += features
+        sink.write(features)
+        n_features += len(features)
         index += 1
 
-    return data, index
+    return n_features, index
 
 def main(start):
 
-    i = start
+    with FeatureSink(OUTPUT, crs=CRS) as sink:
+        start_idx = start
+        _, stop_idx = iterate(start_idx, sink)
 
-    start_idx = i
-    data, stop_idx = iterate(i)
-
-    print(start_idx, stop_idx)
-    while((start_idx + 1 < stop_idx) or start_idx < ):
-        start_idx = stop_idx + 1
-        data_i, stop_idx = iterate(start_idx)
         print(start_idx, stop_idx)
-        save_json(data_i, f'/output/cache/data_{start_idx}_{stop_idx}')
-        data += data_i
-
-    data = {
-        'type': 'FeatureCollection',
-        'features': data,
-        'crs': {'type': 'name', 'properties': {'name': 'epsg:42104'}}
-    }
+        # skip an empty page, as long as the previous run found data
+        while start_idx < stop_idx:
+            start_idx = stop_idx + 1
+            _, stop_idx = iterate(start_idx, sink)
+            print(start_idx, stop_idx)
 
-    save_json(data, './output/s3r_vsmpe.geojson')
+    print(f'{sink.n_features} features saved to {sink.filename}')
 
 if __name__ == '__main__':
     main(1)